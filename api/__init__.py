@@ -15,7 +15,10 @@ def create_app():
     db.init_app(app)
 
     with app.app_context():
+        from . import metrics
+        metrics.configure(app.config)  # Optional ddtrace forwarding
         from . import routes  # Import routes
+        from . import commands  # Register flask cli commands
         db.create_all()  # Create database tables for our data models
 
         return app
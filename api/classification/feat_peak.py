@@ -1,6 +1,7 @@
 from scipy.signal import find_peaks
 import numpy as np
-import math
+
+from .matcher import PeakMatcher
 
 def search_peaks(x_data, y_data, height=0.1, distance=10):
     prominence = np.mean(y_data)
@@ -27,20 +28,14 @@ def search_database_peaks(all_spectrum, height=0.1, distance=10):
     return peaks_database
 
 
-def compare_peaks(peaks_database, peaks, abs_tol=5):
-    coincide_information = {}
-
-    for key in list(peaks_database.keys()):
-        coincide_list = []
-        for peak_d in peaks_database[key]:
-            for peak in peaks:
-                if math.isclose(peak[0], peak_d[0], abs_tol=abs_tol):
-                    coincide_list.append([peak_d[0], peak[0]])
-
-        coincide_information.update(
-            {key: {'coincide_list': coincide_list, 'coincide_number': [len(peaks_database[key]), len(coincide_list)]}})
-
-    return coincide_information
+def compare_peaks(peaks_database, peaks, abs_tol=5, candidates=None):
+    # peaks_database is a {key: peaks} dict or a prebuilt PeakMatcher,
+    # candidates limits the result to those key indices, see prefilter.PeakBinIndex
+    if not isinstance(peaks_database, PeakMatcher):
+        peaks_database = PeakMatcher(peaks_database)
+    if candidates is not None:
+        return peaks_database.compare_candidates(peaks, candidates, abs_tol=abs_tol)
+    return peaks_database.compare(peaks, abs_tol=abs_tol)
 
 
 def judge_matter(coincide_information, criterion=0.99):
@@ -53,12 +48,32 @@ def judge_matter(coincide_information, criterion=0.99):
     return contain_dict
 
 
-def classify(x_data, y_data, all_spectrum):
+def classify(x_data, y_data, database_peaks):
+    # database_peaks is precomputed, see api.peak_index.get_matchers
     peaks = search_peaks(x_data,y_data)
-    database_peaks = search_database_peaks(all_spectrum)
-    print(database_peaks)
     compare_result = compare_peaks(database_peaks,peaks)
     # pass
     # print(compare_result)
     return compare_result
     compare_result=judge_matter(compare_result)
+
+
+def classify_batch(spectra, database_peaks, prefilter=None, limit=100):
+    # one matcher pass for all [(x_data, y_data), ...], failed items hold their error,
+    # with a prefilter each item is only compared with its candidates
+    peaks_list = []
+    for x_data, y_data in spectra:
+        try:
+            peaks_list.append(search_peaks(x_data, y_data))
+        except ValueError as error:
+            peaks_list.append(error)
+
+    if not isinstance(database_peaks, PeakMatcher):
+        database_peaks = PeakMatcher(database_peaks)
+    if prefilter is not None:
+        return [peaks if isinstance(peaks, Exception) else
+                database_peaks.compare_candidates(peaks, prefilter.candidates(peaks, limit))
+                for peaks in peaks_list]
+    found = [peaks for peaks in peaks_list if not isinstance(peaks, Exception)]
+    results = iter(database_peaks.compare_batch(found))
+    return [peaks if isinstance(peaks, Exception) else next(results) for peaks in peaks_list]
@@ -0,0 +1,127 @@
+import numpy as np
+
+
+def isclose(a, b, rel_tol=1e-9, abs_tol=0.0):
+    # vectorized math.isclose
+    return np.abs(a - b) <= np.maximum(rel_tol * np.maximum(np.abs(a), np.abs(b)), abs_tol)
+
+
+def _runs(values):
+    # (value, start, end) of each run of equal values in a sorted array
+    if not len(values):
+        return [], [], []
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    return values[starts].tolist(), starts.tolist(), ends.tolist()
+
+
+class PeakMatcher:
+    """
+    All reference peak positions of a library in one sorted array.
+
+    A query for the peaks of an unknown spectrum is answered with one
+    searchsorted per unknown peak instead of comparing every reference
+    peak with every unknown peak.
+    """
+
+    def __init__(self, peaks_database):
+        self.keys = list(peaks_database.keys())
+        counts = [len(peaks_database[key]) for key in self.keys]
+        self.counts = np.array(counts, dtype=np.int64)
+        # reference peaks in library order, and the key each belongs to
+        self.positions = np.array(
+            [peak[0] for key in self.keys for peak in peaks_database[key]], dtype=float)
+        self.owner = np.repeat(np.arange(len(self.keys)), self.counts)
+        # first position of each key
+        self.offsets = np.cumsum(self.counts) - self.counts
+        self.order = np.argsort(self.positions, kind='stable')
+        self.sorted = self.positions[self.order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def query(self, peaks, abs_tol=0.0, rel_tol=1e-9):
+        """
+        Find every (reference peak, unknown peak) pair that is close.
+
+        :param peaks: unknown peak positions
+        :return: (ref_idx, unknown_idx), index arrays into self.positions and
+                 peaks, ordered by reference peak then unknown peak, which is the
+                 order of the nested loops in compare_peaks.
+        """
+        unknown = np.asarray(peaks, dtype=float)
+        # widest |a - b| that isclose can accept for each unknown peak
+        if rel_tol >= 1:
+            width = np.full(unknown.shape, np.inf)
+        else:
+            width = np.maximum(rel_tol * np.abs(unknown) / (1 - rel_tol), abs_tol)
+        lo = np.searchsorted(self.sorted, unknown - width, 'left')
+        hi = np.searchsorted(self.sorted, unknown + width, 'right')
+
+        # expand the [lo, hi) windows into flat candidate pairs
+        n = hi - lo
+        unknown_idx = np.repeat(np.arange(len(unknown)), n)
+        offset = np.repeat(lo - (np.cumsum(n) - n), n)
+        ref_idx = self.order[np.arange(n.sum()) + offset]
+
+        keep = isclose(unknown[unknown_idx], self.positions[ref_idx], rel_tol, abs_tol)
+        ref_idx, unknown_idx = ref_idx[keep], unknown_idx[keep]
+        order = np.lexsort((unknown_idx, ref_idx))
+        return ref_idx[order], unknown_idx[order]
+
+    def compare(self, peaks, abs_tol=5):
+        """Same result as feat_peak.compare_peaks against the whole library."""
+        return self.compare_batch([peaks], abs_tol=abs_tol)[0]
+
+    def compare_batch(self, peaks_list, abs_tol=5):
+        """compare() for many unknown spectra with a single query."""
+        unknown = np.array([peak[0] for peaks in peaks_list for peak in peaks], dtype=float)
+        item = np.repeat(np.arange(len(peaks_list)), [len(peaks) for peaks in peaks_list])
+        ref_idx, unknown_idx = self.query(unknown, abs_tol=abs_tol)
+
+        # stable, so pairs keep the compare_peaks order within each spectrum
+        order = np.argsort(item[unknown_idx], kind='stable')
+        ref_idx, unknown_idx = ref_idx[order], unknown_idx[order]
+        bounds = np.searchsorted(item[unknown_idx], np.arange(len(peaks_list) + 1))
+        return [self._coincide(ref_idx[start:end], unknown[unknown_idx[start:end]])
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def compare_candidates(self, peaks, candidates, abs_tol=5):
+        """
+        compare() restricted to the keys at the candidates indices, e.g. from
+        prefilter.PeakBinIndex, at a cost that grows with their peaks only.
+        """
+        candidates = np.unique(np.asarray(candidates, dtype=np.int64))
+        n = self.counts[candidates]
+        ref_idx = np.repeat(self.offsets[candidates] - (np.cumsum(n) - n), n) + np.arange(n.sum())
+        unknown = np.array([peak[0] for peak in peaks], dtype=float)
+        # rows in reference peak order, so the pairs keep the compare_peaks order
+        ref_pair, unknown_pair = np.nonzero(
+            isclose(self.positions[ref_idx][:, None], unknown[None, :], abs_tol=abs_tol))
+        return self._coincide(ref_idx[ref_pair], unknown[unknown_pair], candidates)
+
+    def _coincide(self, ref_idx, unknown_x, candidates=None):
+        owner = self.owner[ref_idx]
+        ref_x = self.positions[ref_idx].tolist()
+        unknown_x = unknown_x.tolist()
+        counts = self.counts.tolist()
+
+        coincide_information = {
+            self.keys[i]: {'coincide_list': [], 'coincide_number': [counts[i], 0]}
+            for i in (range(len(self.keys)) if candidates is None else candidates.tolist())}
+        # pairs are grouped by key since ref_idx is sorted
+        for i, start, end in zip(*_runs(owner)):
+            coincide = coincide_information[self.keys[i]]
+            coincide['coincide_list'] = [list(pair) for pair in zip(ref_x[start:end], unknown_x[start:end])]
+            coincide['coincide_number'][1] = end - start
+        return coincide_information
+
+    def assignment(self, peaks, precision=0.03):
+        """
+        (n_keys, n_peaks) matrix, 1 where an unknown peak matches any peak of a
+        key with relative tolerance, like component_testing.compare_unknown_to_known.
+        """
+        ref_idx, unknown_idx = self.query(peaks, rel_tol=precision)
+        matrix = np.zeros((len(self.keys), len(peaks)))
+        matrix[self.owner[ref_idx], unknown_idx] = 1
+        return matrix
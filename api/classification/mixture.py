@@ -0,0 +1,65 @@
+"""
+Mixture decomposition: the unknown is fitted as a non-negative combination of a
+few library spectra. Candidates come from a similarity screen of the unknown and
+of the fit residual, then scipy's NNLS solves the small (points, candidates)
+problem, see SimilarityIndex for the normalized library matrix.
+"""
+import numpy as np
+from scipy.optimize import nnls
+
+from .similarity import preprocess
+
+
+def _fit(A, b, picked):
+    # coefficients over the picked rows of A and the residual of b
+    M = A[picked].T.astype(np.float64)
+    coef, _ = nnls(M, b)
+    return coef, b - M @ coef
+
+
+def decompose_one(A, names, b, candidates=50, min_fraction=0.02, rounds=2):
+    """
+    :param A: (N, D) library rows of unit norm
+    :param b: (D,) unknown of unit norm, preprocessed like A
+    :return: {'components': [(name, fraction), ...] largest first, 'r2': explained share of |b|^2}
+    """
+    b = b.astype(np.float64)
+    if not len(A) or not b.any():
+        return {'components': [], 'r2': 0.0}
+    k = min(candidates, len(A))
+    picked, residual = np.zeros(0, dtype=np.intp), b
+    for _ in range(rounds):
+        # references closest to what is not explained yet
+        scores = A @ residual.astype(A.dtype)
+        picked = np.union1d(picked, np.argpartition(-scores, k - 1)[:k])
+        coef, residual = _fit(A, b, picked)
+        if not residual.any(): break
+
+    # sparse solution: drop the components under min_fraction and refit on the rest
+    while len(picked):
+        keep = (coef > 0) & (coef >= min_fraction * coef.sum())
+        if keep.all(): break
+        picked = picked[keep]
+        if len(picked): coef, residual = _fit(A, b, picked)
+    if not len(picked):
+        return {'components': [], 'r2': 0.0}
+
+    # spectra of the same compound share its fraction
+    fractions = {}
+    for i, c in zip(picked, coef / coef.sum()):
+        fractions[names[i]] = fractions.get(names[i], 0.0) + float(c)
+    r2 = 1.0 - float(residual @ residual) / float(b @ b)
+    return {'components': sorted(fractions.items(), key=lambda item: -item[1]), 'r2': r2}
+
+
+def decompose(index, Y, candidates=50, min_fraction=0.02, rounds=2):
+    """
+    :param index: SimilarityIndex with the cosine metric, its matrix rows are the references
+    :param Y: (n, D) unknowns on the shared grid
+    :return: per unknown, see decompose_one. Fractions are shares of the normalized
+             spectra, i.e. of the signal each compound contributes.
+    """
+    if index.metric != 'cosine':
+        raise ValueError('mixtures are decomposed on the cosine index')
+    B = preprocess(Y, index.metric, index.derivative, index.points)
+    return [decompose_one(index.matrix, index.names, b, candidates, min_fraction, rounds) for b in B]
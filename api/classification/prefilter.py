@@ -0,0 +1,82 @@
+"""
+Candidate generation for the peak matchers: reference peak positions are
+quantized into wavenumber bins and kept in an inverted index from bin to
+library entries. An unknown spectrum only looks up the postings of its own
+bins, so a query costs the number of hits, not the library size.
+"""
+import numpy as np
+
+
+class PeakBinIndex:
+    """
+    Inverted index over the peaks of a PeakMatcher. A query looks up every bin
+    within abs_tol of an unknown peak, so no exact match is lost before the
+    `limit` cut; narrower bins rank closer to the exact matcher.
+    """
+
+    def __init__(self, positions, owner, counts, bin_width=2.5):
+        self.bin_width = float(bin_width)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        # distinct (bin, entry) postings, sorted by bin
+        bins = np.floor(np.asarray(positions, dtype=float) / self.bin_width).astype(np.int64)
+        pairs = np.unique(np.stack([bins, np.asarray(owner, dtype=np.int64)], axis=1), axis=0)
+        self.bins, self.starts = np.unique(pairs[:, 0], return_index=True)
+        self.starts = np.r_[self.starts, len(pairs)]
+        self.members = pairs[:, 1]
+        # distinct bins of each entry
+        self.bin_counts = np.bincount(self.members, minlength=len(self.counts))
+
+    @classmethod
+    def from_matcher(cls, matcher, bin_width=2.5):
+        return cls(matcher.positions, matcher.owner, matcher.counts, bin_width)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def candidates(self, peaks, limit=100, abs_tol=5):
+        """
+        :param peaks: unknown peaks as from feat_peak.search_peaks
+        :param abs_tol: tolerance of the exact matcher, every bin within it of a peak is looked up
+        :return: indices of at most `limit` library entries, most of their bins hit first
+        """
+        unknown = np.array([peak[0] for peak in peaks], dtype=float)
+        if not len(unknown) or not len(self.bins):
+            return np.zeros(0, dtype=np.int64)
+        lo = np.floor((unknown - abs_tol) / self.bin_width).astype(np.int64)
+        n = np.floor((unknown + abs_tol) / self.bin_width).astype(np.int64) - lo + 1
+        query = np.unique(np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum()))
+        at = np.searchsorted(self.bins, query)
+        at = at[(at < len(self.bins)) & (self.bins[np.minimum(at, len(self.bins) - 1)] == query)]
+        if not len(at):
+            return np.zeros(0, dtype=np.int64)
+
+        # postings of all hit bins, one per bin of an entry near an unknown peak
+        n = self.starts[at + 1] - self.starts[at]
+        hits = self.members[np.repeat(self.starts[at] - (np.cumsum(n) - n), n) + np.arange(n.sum())]
+        entries, shared = np.unique(hits, return_counts=True)
+        score = shared / self.bin_counts[entries]
+        if len(entries) > limit:
+            top = np.argpartition(-score, limit - 1)[:limit]
+            entries, score, shared = entries[top], score[top], shared[top]
+        return entries[np.lexsort((-shared, -score))]
+
+
+def measure_recall(matcher, index, peaks_list, limit=100, top=10, abs_tol=5):
+    """
+    Recall of the candidate lists against exhaustive search: for each unknown,
+    the share of its `top` best references by exact coincidence fraction that
+    are among its candidates. References tied with the top-th are as good, so
+    hits among them count up to `top`; zero fractions never count.
+
+    :return: mean recall over the unknowns that match anything
+    """
+    recalls = []
+    for peaks in peaks_list:
+        exact = matcher.compare(peaks, abs_tol=abs_tol)
+        fraction = np.array([c['coincide_number'][1] / max(c['coincide_number'][0], 1) for c in exact.values()])
+        if not fraction.any(): continue
+        cut = max(np.sort(fraction)[-min(top, len(fraction))], np.finfo(float).tiny)
+        truth = np.flatnonzero(fraction >= cut)
+        hits = np.isin(truth, index.candidates(peaks, limit, abs_tol)).sum()
+        recalls.append(min(hits, top) / min(len(truth), top))
+    return float(np.mean(recalls)) if recalls else None
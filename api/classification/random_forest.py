@@ -1,7 +1,10 @@
 from sklearn.ensemble import RandomForestClassifier
 
+def rf_model():
+    return RandomForestClassifier(n_estimators=10)
+
 def rf_clf(sample, data):   
-    clf = RandomForestClassifier(n_estimators=10)
+    clf = rf_model()
     clf.fit(data[0], data[1])
     return clf.predict(sample)[0]
     return 'rf clf'
@@ -1 +1,12 @@
-spectral_shape = (1, 128)
\ No newline at end of file
+from os import path
+
+spectral_shape = (1, 128)
+# wavenumber range covered by the spectral_shape points
+spectral_range = (50, 3500)
+
+folder = path.dirname(path.abspath(__file__))
+# train.npy and obj.pkl, in the api folder
+cache_dir = path.abspath(path.join(folder, '..', '..'))
+# chunked training dataset, see dataset.py
+dataset_dir = path.join(cache_dir, 'siamese-dataset')
+model_path = path.join(folder, 'siamese.h5')
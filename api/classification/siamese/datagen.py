@@ -12,27 +12,155 @@ import numpy as np
 import keras.backend as K
 from keras.utils import Sequence
 
+def solve(cost):
+    # row -> column of the linear assignment minimizing cost
+    if segment: return linear_sum_assignment(cost)[1]
+    x, _, _ = lapjv(cost)
+    return x
+
+
+def random_negatives(data, x, rows, tries=10):
+    """
+    Pair rows whose partner in x has their own class with a random sample of
+    another class instead. x stops being a permutation for those rows.
+    """
+    n = len(data.labels)
+    for _ in range(tries):
+        rows = rows[data.labels[x[rows]] == data.labels[rows]]
+        if not len(rows): return x
+        x[rows] = np.random.randint(n, size=len(rows))
+    for r in rows[data.labels[x[rows]] == data.labels[rows]]:
+        others = np.flatnonzero(data.labels != data.labels[r])
+        if not len(others): raise ValueError('negative pairs need at least two classes')
+        x[r] = np.random.choice(others)
+    return x
+
+
+def block_bounds(n, size):
+    # bounds of blocks of `size`, a short tail joins the previous block since a
+    # block of one would pair a sample with itself
+    bounds = list(range(0, n, size)) + [n]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < size//2: del bounds[-2]
+    return bounds
+
+
+class LapMiner:
+    """Exact hard negatives: one linear assignment over the dense (N, N) cost matrix."""
+    def assign(self, data):
+        if segment:
+            # Using slow scipy. Make small batches.
+            tmp    = []
+            bounds = block_bounds(data.score.shape[0], 512)
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                _, x = linear_sum_assignment(data.score[start:end, start:end])
+                tmp.append(x + start)
+            # a block holding a single class has no negative inside
+            return random_negatives(data, np.concatenate(tmp), np.arange(data.score.shape[0]))
+        # Solve the linear assignment problem
+        x, _, _ = lapjv(data.score)
+        return x
+
+    def forbid(self, data, x, y):
+        # Force a different choice for an eventual next epoch.
+        data.score[x,y] = 10000.0
+        data.score[y,x] = 10000.0
+
+
+class BlockMiner(LapMiner):
+    """
+    Exact assignments inside blocks of `block_size` samples, O(N*block_size^2)
+    per epoch. Every class is spread evenly over the blocks, so each block can
+    pair its samples with other classes. The dense cost matrix is only read a
+    block at a time and may be memory-mapped.
+    """
+    def __init__(self, block_size=512):
+        self.block_size = block_size
+
+    def assign(self, data):
+        # stratified order: samples of a class at evenly spaced ranks
+        key = np.empty(len(data.labels))
+        for ts in data.positions:
+            key[ts] = (np.random.permutation(len(ts)) + np.random.random_sample())/len(ts)
+        order = np.argsort(key, kind='stable')
+        bounds = block_bounds(len(order), self.block_size)
+        x = np.empty(len(order), dtype=np.int64)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            block = order[start:end]
+            x[block] = block[solve(np.asarray(data.score[np.ix_(block, block)]))]
+        # blocks holding a single class have no negative inside
+        return random_negatives(data, x, np.arange(len(x)))
+
+
+class TopkMiner:
+    """
+    Approximate hard negatives from the (N, k) candidates of score.score_topk:
+    greedy assignment of the best scoring free candidate pairs, the remaining
+    samples are paired at random with other classes. O(N*k*log(N*k)) per epoch.
+    """
+    def assign(self, data):
+        idx, cost = data.score
+        n, k = idx.shape
+        flat = np.argsort(cost, axis=None, kind='stable')
+        flat = flat[np.isfinite(cost.ravel()[flat])]
+        x     = [-1]*n
+        taken = [False]*n
+        for r, c in zip((flat//k).tolist(), idx.ravel()[flat].tolist()):
+            if x[r] < 0 and not taken[c]:
+                x[r]     = c
+                taken[c] = True
+        x     = np.array(x)
+        rows  = np.flatnonzero(x < 0)
+        cols  = np.random.permutation(np.flatnonzero(~np.array(taken, dtype=bool)))
+        x[rows] = cols
+        return random_negatives(data, x, rows)
+
+    def forbid(self, data, x, y):
+        # both directions of every pair, x may repeat samples
+        idx, cost = data.score
+        cost[idx[y] == x[:, None]] = np.inf
+        r, c = np.nonzero(idx[x] == y[:, None])
+        cost[x[r], c] = np.inf
+
+
+MINERS = {'exact': LapMiner, 'block': BlockMiner, 'topk': TopkMiner}
+
+
 class TrainingData(Sequence):
-    def __init__(self, score, train, id2samples, train_idx, steps=1000, batch_size=32):
+    def __init__(self, score, train, id2samples, train_idx, steps=1000, batch_size=32, copy=True, miner='exact'):
+        """
+        :param score: (N, N) matrix of pair scores in train_idx order, or the
+                      (indexes, scores) pair of score.score_topk for miner='topk'
+        :param miner: 'exact' (lapjv), 'block', 'topk' or a miner instance
+        """
         super(TrainingData, self).__init__()
-        # Maximizing the score is the same as minimuzing -score.
-        self.score      = -score 
         self.train      = train
         self.dims       = train.shape[1]
         self.steps      = steps
         self.batch_size = batch_size
         self.id2samples = id2samples
         self.train_idx = train_idx
+        self.miner      = MINERS[miner]() if isinstance(miner, str) else miner
         
         t2i = {}
         for i,t in enumerate(train_idx): t2i[t] = i
-        
-        for ts in id2samples.values():
-            idxs = [t2i[t] for t in ts]
-            for i in idxs:
-                for j in idxs:
-                    # Set a large value for matching whales -- eliminates this potential pairing
-                    self.score[i,j] = 10000.0 
+        # positions of each class in train_idx order
+        self.positions = [np.array([t2i[t] for t in ts], dtype=np.int64) for ts in id2samples.values()]
+        self.labels    = np.empty(len(train_idx), dtype=np.int64)
+        for label, idxs in enumerate(self.positions): self.labels[idxs] = label
+
+        # Maximizing the score is the same as minimuzing -score.
+        if isinstance(score, tuple):
+            idx, val   = score
+            cost       = -np.asarray(val, dtype=np.float64)
+            # matching classes are never candidates
+            cost[self.labels[idx] == self.labels[:, None]] = np.inf
+            self.score = (idx, cost)
+        else:
+            # copy=False negates score in place instead of holding a second N x N matrix.
+            self.score = -score if copy else np.negative(score, out=score)
+            for idxs in self.positions:
+                # Set a large value for matching whales -- eliminates this potential pairing
+                self.score[np.ix_(idxs, idxs)] = 10000.0
                     
         self.on_epoch_end()
     
@@ -44,22 +172,7 @@ class TrainingData(Sequence):
         self.match      = []
         self.unmatch    = []
 
-        if segment:
-            # Using slow scipy. Make small batches.
-            tmp   = []
-            batch = 512
-            for start in range(0, score.shape[0], batch):
-                end = min(score.shape[0], start + batch)
-                _, x = linear_sum_assignment(self.score[start:end, start:end])
-                tmp.append(x + start)
-            x = np.concatenate(tmp)
-        else:        
-            # Solve the linear assignment problem
-            
-            # _,_, x = lapjv(self.score) 
-            # import ipdb; ipdb.set_trace()
-            x, _, _ = lapjv(self.score)
-            
+        x = self.miner.assign(self)
         y = np.arange(len(x), dtype=np.int32)
 
         # Compute a derangement for matching whales
@@ -70,58 +183,82 @@ class TrainingData(Sequence):
                 if not np.any(ts == d): break
             for ab in zip(ts, d): self.match.append(ab)
         
-        if 1:
-            # Construct unmatched pairs from the LAP solution.
-            for i,j in zip(x,y):
-                if i == j:
-                    print(f'i {i} == j {j}')
-                    # print(self.score)
-                    print(x)
-                    print(y)
-                assert i != j
-                self.unmatch.append((self.train_idx[i], self.train_idx[j]))
-
-            # Force a different choice for an eventual next epoch.
-            self.score[x,y] = 10000.0
-            self.score[y,x] = 10000.0
+        # Construct unmatched pairs from the LAP solution.
+        for i,j in zip(x,y):
+            assert i != j
+            self.unmatch.append((self.train_idx[i], self.train_idx[j]))
+
+        self.miner.forbid(self, x, y)
             
         random.shuffle(self.match)
         random.shuffle(self.unmatch)
         
         assert len(self.match) == len(self.train) and len(self.unmatch) == len(self.train)
+
+        # Batches alternate a match and an unmatch pair, gathered with one fancy index.
+        self.pairs       = np.empty((2*len(self.match), 2), dtype=np.int64)
+        self.pairs[0::2] = self.match
+        self.pairs[1::2] = self.unmatch
+        self.c           = np.zeros((len(self.pairs), 1), dtype=K.floatx())
+        self.c[0::2]     = 1
         
     def __len__(self):
         return (len(self.match) + len(self.unmatch) + self.batch_size - 1) // self.batch_size
     
     def __getitem__(self, index):
+        return self.gather(index)
+
+    def gather(self, index, a=None, b=None):
+        """
+        Batch `index` as ([a, b], c). The rows of both sides are gathered with one
+        np.take each, into a and b if given, preallocated (batch_size, ...) buffers.
+        """
         start = self.batch_size * index
-        end   = min(start + self.batch_size, len(self.match) + len(self.unmatch))
-        size  = end - start
-        assert size > 0
-        
-        a     = np.zeros((size,) + (self.dims,), dtype=K.floatx())
-        b     = np.zeros((size,) + (self.dims,), dtype=K.floatx())
-        c     = np.zeros((size,1), dtype=K.floatx())
-        j     = start//2
+        end   = min(start + self.batch_size, len(self.pairs))
+        assert end > start
         
-        for i in range(0, size, 2):
-            a[i,  :] = self.train[self.match[j][0]]
-            b[i,  :] = self.train[self.match[j][1]]
-            # This is a match
-            c[i,  0] = 1 
+        pairs = self.pairs[start:end]
+        shape = (end - start,) + self.train.shape[1:]
+        a     = np.take(self.train, pairs[:,0], axis=0, mode='clip',
+                        out=np.empty(shape, dtype=K.floatx()) if a is None else a[:end - start])
+        b     = np.take(self.train, pairs[:,1], axis=0, mode='clip',
+                        out=np.empty(shape, dtype=K.floatx()) if b is None else b[:end - start])
+        return [a[:,None,],b[:,None,]],self.c[start:end]
+
+    def as_dataset(self, prefetch=2, epochs=None):
+        """
+        tf.data pipeline of the same batches for model.fit(..., steps_per_epoch=len(data)),
+        `epochs` passes, by default the ones left in steps. The generator gathers the
+        rows of each batch from train, which may stay memory-mapped, into a ring of
+        preallocated buffers, and prefetching overlaps that with training, so fit needs
+        no worker processes. Between passes on_epoch_end assigns new pairs, as with the
+        Sequence, but not after the last one.
+        """
+        import tensorflow as tf
+
+        epochs = self.steps + 1 if epochs is None else epochs
+        # tensors may alias the yielded arrays: one buffer pair for every batch that can
+        # be in flight, the prefetched ones, the one in training and the one being filled
+        shape   = (self.batch_size,) + tuple(self.train.shape[1:])
+        buffers = [(np.empty(shape, dtype=K.floatx()), np.empty(shape, dtype=K.floatx()))
+                   for _ in range(prefetch + 3)]
 
-            a[i+1,:] = self.train[self.unmatch[j][0]]
-            b[i+1,:] = self.train[self.unmatch[j][1]]
-            # unmatch
-            c[i+1,0] = 0 
-            j           += 1
-        return [a[:,None,],b[:,None,]],c    
+        def batches():
+            for epoch in range(epochs):
+                if epoch: self.on_epoch_end()
+                for index in range(len(self)):
+                    (a, b), c = self.gather(index, *buffers[(epoch*len(self) + index) % len(buffers)])
+                    yield (a, b), c
 
+        spectrum = tf.TensorSpec((None, 1) + tuple(self.train.shape[1:]), K.floatx())
+        dataset = tf.data.Dataset.from_generator(batches, output_signature=(
+            (spectrum, spectrum), tf.TensorSpec((None, 1), K.floatx())))
+        return dataset.prefetch(prefetch)
 
 if __name__ == '__main__':
-    from utils import load_cache, group_label, shuffle_idxs
+    from .utils import load_cache, group_label, shuffle_idxs
     
-    train, y_, _, _ = load_cache('../../')
+    train, y_, _, _ = load_cache()
     score = np.random.random_sample(size=(len(train), len(train)))
     id2samples = group_label(y_)
     train_idx, _ = shuffle_idxs(train)
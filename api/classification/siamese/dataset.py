@@ -0,0 +1,160 @@
+"""
+Training dataset of the siamese model, a folder of
+
+    meta.json          format, version, grid, label names, chunks and the last exported spectrum id
+    spectra-00000.npy  (n, 128) float32 spectra on the spectral_shape grid, see to_input
+    labels-00000.npy   (n,) int32 label codes, meta['labels'][code] is the label
+    ids-00000.npy      (n,) int64 ids of the Spectrum rows
+
+New spectra are appended as new chunks. Readers memory-map the chunks and never
+change the folder; append, compact and rebuild hold an exclusive lock on
+.lock and start from the meta.json on disk, so an older handle cannot undo
+another writer's work.
+"""
+from contextlib import contextmanager
+import json
+import os
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks, single writer only
+    fcntl = None
+
+from .config import spectral_shape, spectral_range
+from ..grid import resample
+
+FORMAT = 'siamese-dataset'
+VERSION = 1
+KINDS = {'spectra': np.float32, 'labels': np.int32, 'ids': np.int64}
+
+
+def to_input(xs, ys):
+    # spectra on any x axis -> (N, 128) rows over spectral_range, scaled to their maximum
+    data = resample(xs, ys, np.linspace(*spectral_range, spectral_shape[-1]))
+    scale = np.abs(data).max(axis=1, keepdims=True)
+    return np.divide(data, scale, out=data, where=scale > 0)
+
+
+class Dataset:
+    def __init__(self, folder, rebuild=False):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        if rebuild:
+            with self.lock(reload=False):
+                for name in os.listdir(folder):
+                    if name == 'meta.json' or name.split('-')[0] in KINDS: os.remove(self.path(name))
+        self.read_meta()
+
+    @contextmanager
+    def lock(self, reload=True):
+        # exclusive between writers of this folder, meta is re-read once held
+        with open(self.path('.lock'), 'w') as f:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if reload: self.read_meta()
+                yield
+            finally:
+                if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_meta(self):
+        folder = self.folder
+        if os.path.exists(self.path('meta.json')):
+            with open(self.path('meta.json'), encoding='utf-8') as f:
+                self.meta = json.load(f)
+            if self.meta.get('format') != FORMAT or self.meta.get('version') != VERSION:
+                raise ValueError(f'{folder} is not a {FORMAT} version {VERSION}')
+            if self.meta['spectral_shape'] != list(spectral_shape) or self.meta['spectral_range'] != list(spectral_range):
+                raise ValueError(f'{folder} was exported on another grid, rebuild it')
+        else:
+            self.meta = {'format': FORMAT, 'version': VERSION, 'spectral_shape': list(spectral_shape),
+                         'spectral_range': list(spectral_range), 'labels': [], 'chunks': [], 'last_id': 0}
+        self.label2id = {label: i for i, label in enumerate(self.meta['labels'])}
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.meta['chunks'])
+
+    @property
+    def last_id(self):
+        return self.meta['last_id']
+
+    def write_meta(self):
+        # the new meta.json replaces the old one at once, readers see the old or new chunk list
+        with open(self.path('meta.json.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(self.path('meta.json.tmp'), self.path('meta.json'))
+
+    def append(self, spectra, labels, ids=None, last_id=None):
+        """
+        :param spectra: (n, 128) spectra from to_input
+        :param labels: n label names, new ones get the next codes
+        :param ids: n Spectrum ids
+        :param last_id: highest Spectrum id exported so far, for the next append
+        """
+        with self.lock():
+            if len(spectra):
+                codes = []
+                for label in labels:
+                    if label not in self.label2id:
+                        self.label2id[label] = len(self.meta['labels'])
+                        self.meta['labels'].append(label)
+                    codes.append(self.label2id[label])
+                number = max([chunk['number'] for chunk in self.meta['chunks']], default=-1) + 1
+                arrays = {'spectra': spectra, 'labels': codes, 'ids': np.full(len(spectra), -1) if ids is None else ids}
+                for kind, array in arrays.items():
+                    np.save(self.path(f'{kind}-{number:05d}.npy'), np.asarray(array, dtype=KINDS[kind]))
+                self.meta['chunks'].append({'number': number, 'rows': len(spectra)})
+            if last_id is not None: self.meta['last_id'] = max(self.meta['last_id'], last_id)
+            self.write_meta()
+
+    def open(self, kind, mmap_mode='r'):
+        """
+        One array of all chunks, memory-mapped when there is a single chunk and
+        concatenated otherwise, see compact. Never changes the folder.
+        """
+        for retry in (True, False):
+            chunks = self.meta['chunks']
+            if not chunks:
+                return np.zeros((0,) + spectral_shape[1:] if kind == 'spectra' else (0,), dtype=KINDS[kind])
+            try:
+                arrays = [np.load(self.path(f"{kind}-{chunk['number']:05d}.npy"), mmap_mode=mmap_mode)
+                          for chunk in chunks]
+                return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+            except FileNotFoundError:
+                # compacted by a writer since meta was read
+                if not retry: raise
+                self.read_meta()
+
+    def compact(self):
+        # stream the chunks into one, never more than one chunk in memory
+        with self.lock():
+            if len(self.meta['chunks']) > 1: self._compact()
+
+    def _compact(self):
+        chunks = self.meta['chunks']
+        number = max(chunk['number'] for chunk in chunks) + 1
+        rows = len(self)
+        for kind, dtype in KINDS.items():
+            first = np.load(self.path(f"{kind}-{chunks[0]['number']:05d}.npy"), mmap_mode='r')
+            out = np.lib.format.open_memmap(self.path(f'{kind}-{number:05d}.npy'), mode='w+',
+                                            dtype=dtype, shape=(rows,) + first.shape[1:])
+            start = 0
+            for chunk in chunks:
+                out[start:start + chunk['rows']] = np.load(self.path(f"{kind}-{chunk['number']:05d}.npy"), mmap_mode='r')
+                start += chunk['rows']
+            out.flush()
+            del out
+        self.meta['chunks'] = [{'number': number, 'rows': rows}]
+        self.write_meta()
+        for chunk in chunks:
+            for kind in KINDS:
+                os.remove(self.path(f"{kind}-{chunk['number']:05d}.npy"))
+
+    def load(self, mmap_mode='r'):
+        # same as utils.load_cache: train, y_, label2id, id2label
+        id2label = dict(enumerate(self.meta['labels']))
+        return self.open('spectra', mmap_mode), self.open('labels', mmap_mode), dict(self.label2id), id2label
@@ -0,0 +1,127 @@
+"""
+Incremental training: warm start from siamese.h5 and fine-tune only on the
+classes added since it was saved, plus a replay buffer of the old classes.
+
+    python -m api.classification.siamese.incremental
+"""
+import json
+import os
+import random
+
+import numpy as np
+
+from .config import model_path
+from .datagen import TrainingData
+from .model import build_model
+from .score import FeatureGen, score_matrix, add_noise
+from .utils import load_cache, group_label, shuffle_idxs
+
+
+def labels_path(path=model_path):
+    # labels the model at path was trained on, next to it
+    return os.path.splitext(path)[0] + '.json'
+
+
+def trained_labels(path=model_path):
+    try:
+        with open(labels_path(path), encoding='utf-8') as f:
+            return set(json.load(f)['labels'])
+    except FileNotFoundError:
+        return None
+
+
+def label_names(y_, id2label):
+    # y_ are codes of id2label in the chunked dataset, names in the legacy cache
+    return np.array([id2label.get(c, c) for c in np.asarray(y_).tolist()], dtype=object)
+
+
+def save_model(model, labels, path=model_path):
+    model.save(path)
+    with open(labels_path(path), 'w', encoding='utf-8') as f:
+        json.dump({'labels': sorted(set(labels))}, f, ensure_ascii=False)
+
+
+class EmbeddingCache:
+    """Branch model features of training samples, only recomputed once older than max_age rounds."""
+    def __init__(self, branch_model, train):
+        self.branch_model = branch_model
+        self.train        = train
+        self.features     = None
+        self.age          = np.full(len(train), np.inf)
+
+    def get(self, idxs, max_age=1):
+        idxs  = np.asarray(idxs)
+        stale = idxs[self.age[idxs] >= max_age]
+        if len(stale):
+            features = self.branch_model.predict(FeatureGen(self.train, stale), verbose=0)
+            if self.features is None:
+                self.features = np.zeros((len(self.train), features.shape[1]), dtype=features.dtype)
+            self.features[stale] = features
+            self.age[stale]      = 0
+        return self.features[idxs]
+
+    def tick(self):
+        self.age += 1
+
+
+def replay_buffer(groups, labels, size, per_class=4):
+    # a few samples of randomly chosen old classes, at least 2 per class for the matches
+    labels = [label for label in labels if len(groups[label]) >= 2]
+    random.shuffle(labels)
+    picked = []
+    for label in labels:
+        if len(picked) >= size: break
+        ts = groups[label]
+        picked.extend(np.random.choice(ts, min(per_class, len(ts)), replace=False))
+    return np.array(picked, dtype=np.int64)
+
+
+def fine_tune(train, names, epochs=20, step=5, replay=2000, per_class=4, refresh=3, ampl=0.5, lr=4e-5,
+              miner='exact', path=model_path):
+    """
+    :param names: label name of every sample of train
+    :param replay: number of old-class samples trained with the new ones
+    :param refresh: replay embeddings are recomputed every `refresh` rounds, new ones every round
+    :return: the fine-tuned model, None when there are no new classes
+    """
+    known = trained_labels(path)
+    if known is None:
+        raise ValueError(f'{labels_path(path)} is missing, train the full model with train.py first')
+    groups = group_label(names)
+    new    = [label for label in groups if label not in known and len(groups[label]) >= 2]
+    if not new:
+        print('no new classes to train')
+        return None
+
+    model, branch_model, head_model = build_model(lr, 0)
+    model.load_weights(path)
+
+    fresh  = np.concatenate([groups[label] for label in new])
+    subset = np.sort(np.concatenate([fresh, replay_buffer(groups, [l for l in groups if l in known], replay, per_class)]))
+    isnew  = np.isin(subset, fresh)
+    print(f'{len(new)} new classes, {len(fresh)} new and {len(subset) - len(fresh)} replay samples')
+
+    # sub[i] is train[subset[i]], small enough for memory
+    sub        = np.asarray(train[subset])
+    id2samples = group_label(names[subset])
+    cache      = EmbeddingCache(branch_model, sub)
+
+    steps = 0
+    while steps < epochs:
+        train_idx = np.array(shuffle_idxs(sub)[0])
+        features  = cache.get(train_idx, np.where(isnew[train_idx], 1, refresh))
+        score     = add_noise(score_matrix(head_model, features, verbose=0), ampl)
+        data      = TrainingData(score, sub, id2samples, train_idx, steps=step, batch_size=32, copy=False, miner=miner)
+        history   = model.fit(data.as_dataset(), steps_per_epoch=len(data),
+                              initial_epoch=steps, epochs=steps + step, verbose=0).history
+        steps += step
+        cache.tick()
+        print(steps, history['loss'][-1])
+
+    save_model(model, list(known) + new, path)
+    return model
+
+
+if __name__ == '__main__':
+    train, y_, _, id2label = load_cache()
+    fine_tune(train, label_names(y_, id2label))
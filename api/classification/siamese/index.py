@@ -0,0 +1,132 @@
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+
+import numpy as np
+import keras.backend as K
+
+from .config import spectral_shape, cache_dir, model_path
+
+
+def reference_key(train):
+    # digest of the reference spectra an index was built from
+    return hashlib.sha1(np.ascontiguousarray(train, dtype=K.floatx()).tobytes()).hexdigest()
+
+
+def embed(branch_model, data, batch_size=256):
+    # branch_model once per spectrum, data is (N, 128) -> (N, 512) float32
+    data = np.asarray(data, dtype=K.floatx()).reshape((-1,) + spectral_shape)
+    return branch_model.predict(data, batch_size=batch_size, verbose=0).astype(np.float32)
+
+
+def normalize(features):
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """
+    Branch model embeddings of the reference spectra, kept as one (N, 512) matrix.
+    An unknown spectrum is embedded once, the k nearest references by cosine
+    similarity are shortlisted, and only those k pairs go through the head model
+    instead of all N (or N(N-1)/2 with ScoreGen).
+    """
+    def __init__(self, features, y_, key=None):
+        self.features = features
+        self.unit     = normalize(features)
+        self.y_       = np.asarray(y_)
+        self.key      = key
+
+    @classmethod
+    def build(cls, branch_model, train, y_, batch_size=256):
+        return cls(embed(branch_model, train, batch_size), y_, reference_key(train))
+
+    def save(self, folder):
+        """Written to a temp folder and moved into place, readers never see a partial index."""
+        tmp = f'{folder}.{os.getpid()}-{threading.get_ident()}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, 'embeddings.npy'), self.features)
+        with open(os.path.join(tmp, 'embeddings.pkl'), 'wb') as f:
+            pickle.dump({'y_': self.y_, 'key': self.key}, f)
+        try:
+            os.replace(tmp, folder)
+        except OSError:
+            # another worker saved it first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, folder, train=None):
+        """Memory-mapped index from `save`, None if missing, unreadable or built from other references."""
+        try:
+            with open(os.path.join(folder, 'embeddings.pkl'), 'rb') as f:
+                obj = pickle.load(f)
+            features = np.load(os.path.join(folder, 'embeddings.npy'), mmap_mode='r')
+        except Exception:
+            # missing, or partial files of an interrupted save: a cache miss either way
+            return None
+        if train is not None and obj.get('key') != reference_key(train):
+            return None
+        return cls(features, obj['y_'], obj['key'])
+
+    def __len__(self):
+        return len(self.features)
+
+    def shortlist(self, queries, k=10):
+        """
+        :param queries: (M, 512) embeddings of unknown spectra
+        :return: (M, k) reference indexes, most similar first, and their cosine similarity
+        """
+        k = min(k, len(self))
+        sim = normalize(np.asarray(queries, dtype=np.float32)) @ self.unit.T
+        top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+        top_sim = np.take_along_axis(sim, top, axis=1)
+        order = np.argsort(-top_sim, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_sim, order, axis=1)
+
+    def score(self, head_model, queries, k=10, batch_size=2048):
+        """
+        Head model scores of each query against its k shortlisted references.
+
+        :return: (M, k) reference indexes and (M, k) head scores, best score first
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        top, _ = self.shortlist(queries, k)
+        a = np.asarray(self.features)[top.ravel()]
+        b = np.repeat(queries, top.shape[1], axis=0)
+        score = head_model.predict([a, b], batch_size=batch_size, verbose=0).reshape(top.shape)
+        order = np.argsort(-score, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(score, order, axis=1)
+
+    def classify(self, branch_model, head_model, data, k=10):
+        """
+        :param data: (M, 128) unknown spectra on the training grid
+        :return: per spectrum a list of (label, score), best first, one entry per label
+        """
+        top, score = self.score(head_model, embed(branch_model, data), k)
+        results = []
+        for idxs, scores in zip(top, score):
+            best = {}
+            for label, s in zip(self.y_[idxs].tolist(), scores):
+                if label not in best: best[label] = float(s)
+            results.append(list(best.items()))
+        return results
+
+
+if __name__ == '__main__':
+    from .utils import load_cache
+    from .model import build_model
+
+    train, y_, _, _ = load_cache()
+    model, branch_model, head_model = build_model(64e-5, 0)
+    if os.path.exists(model_path): model.load_weights(model_path)
+
+    # a folder of its own, save moves the whole folder into place
+    folder = os.path.join(cache_dir, 'embeddings')
+    index = EmbeddingIndex.load(folder, train)
+    if index is None:
+        index = EmbeddingIndex.build(branch_model, train, y_)
+        shutil.rmtree(folder, ignore_errors=True)  # built from other references
+        index.save(folder)
+    print(index.classify(branch_model, head_model, train[:5]))
@@ -5,7 +5,7 @@ from keras.layers import Activation, Add, BatchNormalization, Concatenate, Conv1
 from keras.models import Model
 import keras.backend as K
 
-from config import spectral_shape
+from .config import spectral_shape
 
 def subblock(x, filter, **kwargs):
     x = BatchNormalization()(x)
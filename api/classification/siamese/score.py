@@ -3,27 +3,20 @@ import numpy as np
 import keras.backend as K
 from tqdm import tqdm
 
-from config import spectral_shape
+from .config import spectral_shape
 
 
 class FeatureGen(Sequence):
-    def __init__(self, train, data, batch_size=64, verbose=1):
+    def __init__(self, train, data, batch_size=64):
         super(FeatureGen, self).__init__()
-        self.data       = data
+        self.data       = np.asarray(data)
         self.train      = train
         self.batch_size = batch_size
-        self.verbose    = verbose
-        if self.verbose > 0: self.progress = tqdm(total=len(self), desc='Features')
         
     def __getitem__(self, index):
         start = self.batch_size*index
-        size  = min(len(self.data) - start, self.batch_size)
-        a     = np.zeros((size,) + spectral_shape, dtype=K.floatx())
-        for i in range(size): a[i,:] = self.train[self.data[start + i]]
-        if self.verbose > 0: 
-            self.progress.update()
-            if self.progress.n >= len(self): self.progress.close()
-        return a
+        idxs  = self.data[start:start + self.batch_size]
+        return self.train[idxs].astype(K.floatx(), copy=False).reshape((len(idxs),) + spectral_shape)
     def __len__(self):
         return (len(self.data) + self.batch_size - 1)//self.batch_size
     
@@ -56,17 +49,86 @@ class ScoreGen(Sequence):
         return [a,b]
     def __len__(self):
         return (len(self.ix) + self.batch_size - 1)//self.batch_size
-    
+
+
+def _row_blocks(n, block_pairs):
+    rows = max(1, block_pairs//max(n, 1))
+    return [(start, min(start + rows, n)) for start in range(0, n, rows)]
+
+
+def _score_rows(head_model, features, start, end, cols, batch_size):
+    # head model scores of rows start:end against the features in cols, (end - start, len(cols))
+    a = np.repeat(features[start:end], len(cols), axis=0)
+    b = np.tile(features[cols], (end - start, 1))
+    return head_model.predict([a, b], batch_size=batch_size, verbose=0).reshape((end - start, len(cols)))
+
+
+def score_matrix(head_model, features, out=None, filename=None, block_pairs=1 << 16, batch_size=2048, verbose=1):
+    """
+    Same matrix as score_reshape(head_model.predict(ScoreGen(features)), features),
+    computed a block of rows at a time into one preallocated matrix. The head
+    model is symmetric, so only blocks on and above the diagonal are predicted.
+
+    :param out: (N, N) matrix to write into, e.g. the one of the previous step
+    :param filename: memory-map a new matrix to this .npy file instead of RAM
+    """
+    n = len(features)
+    if out is None:
+        if filename: out = np.lib.format.open_memmap(filename, mode='w+', dtype=K.floatx(), shape=(n, n))
+        else: out = np.empty((n, n), dtype=K.floatx())
+    for start, end in tqdm(_row_blocks(n, block_pairs), desc='Scores', disable=verbose <= 0):
+        block = _score_rows(head_model, features, start, end, np.arange(start, n), batch_size)
+        out[start:end, start:] = block
+        out[start:, start:end] = block.T
+        diag = np.arange(start, end)
+        out[diag, diag] = 0
+    return out
+
+
+def add_noise(score, ampl, block_pairs=1 << 20):
+    # score += ampl*np.random.random_sample(size=score.shape), in place a block of rows at a time
+    for start, end in _row_blocks(score.shape[1], block_pairs):
+        score[start:end] += ampl*np.random.random_sample(size=(end - start, score.shape[1]))
+    return score
+
+
+def score_topk(head_model, features, k, y=None, ampl=0.0, block_pairs=1 << 16, batch_size=2048, verbose=1):
+    """
+    The k best scoring other samples of every sample, without the (N, N) matrix.
+
+    :param y: labels in the order of features, pairs of the same label are skipped
+    :param ampl: amplitude of the uniform noise added to the scores, as in add_noise
+    :return: (N, k) indexes and (N, k) scores, best first
+    """
+    n    = len(features)
+    k    = min(k, n - 1)
+    cols = np.arange(n)
+    y    = None if y is None else np.asarray(y)
+    idx  = np.empty((n, k), dtype=np.int32)
+    val  = np.empty((n, k), dtype=K.floatx())
+    for start, end in tqdm(_row_blocks(n, block_pairs), desc='Scores', disable=verbose <= 0):
+        block = _score_rows(head_model, features, start, end, cols, batch_size)
+        if ampl: block += ampl*np.random.random_sample(size=block.shape)
+        rows = np.arange(end - start)
+        block[rows, rows + start] = -np.inf
+        if y is not None: block[y[start:end, None] == y[None, :]] = -np.inf
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_val = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_val, axis=1)
+        idx[start:end] = np.take_along_axis(top, order, axis=1)
+        val[start:end] = np.take_along_axis(top_val, order, axis=1)
+    return idx, val
+
 if __name__ == '__main__':
-    from utils import load_cache, group_label, shuffle_idxs, score_reshape
+    from .utils import load_cache, group_label, shuffle_idxs, score_reshape
     
-    train, y_, _, _ = load_cache('../../')
+    train, y_, _, _ = load_cache()
     score = np.random.random_sample(size=(len(train), len(train)))
     id2samples = group_label(y_)
     train_idx, _ = shuffle_idxs(train)
     
     
-    from model import build_model
+    from .model import build_model
     model, branch_model, head_model = build_model(64e-5,0)
     
     inp = FeatureGen(train, train_idx)
@@ -1,10 +1,10 @@
 import numpy as np
 import keras.backend as K
-from utils import load_cache, group_label, shuffle_idxs, score_reshape, get_lr, set_lr
+from .utils import load_cache, group_label, shuffle_idxs, score_reshape, get_lr, set_lr
 
-from datagen import TrainingData
-from score import ScoreGen, FeatureGen
-from model import build_model 
+from .datagen import TrainingData
+from .score import ScoreGen, FeatureGen
+from .model import build_model
     
 def test(clf, data, y_, n_splits=2):
     
@@ -15,7 +15,7 @@ def test(clf, data, y_, n_splits=2):
     import pandas
     
     
-    y_.index = list(range(len(y_)))
+    y_ = np.asarray(y_)
     for train_idx, test_idx in skfold.split(data, y_):
         y = clf.predict(data[test_idx])
         
@@ -23,7 +23,7 @@ def test(clf, data, y_, n_splits=2):
         print(f'f1: {f1}, acc: {acc}')    
     
 if __name__ == '__main__':
-    train, y_, _, _ = load_cache('../../')
+    train, y_, _, _ = load_cache()
     model, branch_model, head_model = build_model(1e-6, 0)
     
     test(model, train, y_)
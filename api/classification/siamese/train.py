@@ -1,25 +1,34 @@
 import numpy as np
 import keras.backend as K
-from utils import load_cache, group_label, shuffle_idxs, score_reshape, get_lr, set_lr
+from .utils import load_cache, group_label, shuffle_idxs, get_lr, set_lr
 
-from datagen import TrainingData
-from score import ScoreGen, FeatureGen
-from model import build_model
+from .datagen import TrainingData
+from .score import FeatureGen, score_matrix, score_topk, add_noise
+from .model import build_model
+from .incremental import label_names, save_model
 
-def make_steps(step, ampl):
-    global steps, histories, train, id2samples, train_idx
+def make_steps(step, ampl, score_file=None, miner='exact', topk=None):
+    global steps, histories, train, y_, id2samples, train_idx
         
-    # Compute the match score for each picture pair
-    features = branch_model.predict(FeatureGen(train, train_idx, verbose=1), max_queue_size=12, workers=6, verbose=0)
-    score    = head_model.predict(ScoreGen(features, verbose=1), max_queue_size=12, workers=6, verbose=0)
-    score    = score_reshape(score, features)
+    # Compute the match score for each picture pair, one (N, N) matrix,
+    # memory-mapped to score_file for libraries that don't fit in RAM,
+    # or only the topk best candidates of each sample for miner='topk'
+    features = branch_model.predict(FeatureGen(train, train_idx), verbose=1)
+    if miner == 'topk':
+        score = score_topk(head_model, features, topk or 32, y=np.asarray(y_)[train_idx], ampl=ampl)
+        ms    = np.mean(score[1][np.isfinite(score[1])])
+    else:
+        score = score_matrix(head_model, features, filename=score_file)
+        ms    = np.mean(score)
+        score = add_noise(score, ampl)
     
     # score = np.random.random_sample(size=(len(train), len(train)))
     
     # Train the model for 'step' epochs
+    data    = TrainingData(score, train, id2samples, train_idx, steps=step, batch_size=32, copy=False, miner=miner)
     history = model.fit(
-        TrainingData(score + ampl*np.random.random_sample(size=score.shape), train, id2samples, train_idx, steps=step, batch_size=32),
-        initial_epoch=steps, epochs=steps + step, max_queue_size=12, workers=6, verbose=0,
+        data.as_dataset(epochs=step), steps_per_epoch=len(data),
+        initial_epoch=steps, epochs=steps + step, verbose=0,
         # callbacks=[
         #     # TQDMNotebookCallback(leave_inner=True, metric_format='{value:0.3f}')
         # ]
@@ -28,14 +37,14 @@ def make_steps(step, ampl):
     
     # Collect history data
     history['epochs'] = steps
-    history['ms'    ] = np.mean(score)
+    history['ms'    ] = ms
     history['lr'    ] = get_lr(model)
     print(history['epochs'],history['lr'],history['ms'])
     histories.append(history)
     
     
 if __name__ == '__main__':
-    train, y_, _, _ = load_cache('../../')
+    train, y_, _, id2label = load_cache()
     model, branch_model, head_model = build_model(1e-6, 0)
     id2samples = group_label(y_)
     train_idx, _ = shuffle_idxs(train)
@@ -74,4 +83,4 @@ if __name__ == '__main__':
     # epoch -> 400
     set_lr(model, 1e-5)
     for _ in range(2): make_steps(5, 0.25)
-    model.save('siamese.h5')
\ No newline at end of file
+    save_model(model, label_names(y_, id2label))
\ No newline at end of file
@@ -1,3 +1,4 @@
+import os
 import random
 import pickle
 
@@ -6,6 +7,9 @@ import keras.backend as K
 
 from collections import defaultdict
 
+from .config import cache_dir, dataset_dir
+from .dataset import Dataset
+
 
 def group_label(y_):
     id2samples = defaultdict(list)
@@ -25,9 +29,14 @@ def shuffle_idxs(train):
     return train_idx, t2i
 
 
-def load_cache(folder):
-    obj = pickle.load(open(folder + 'obj.pkl', 'rb'))
-    return np.load(folder + 'train.npy'), obj['y_'], obj['label2id'], obj['id2label']
+def load_cache(folder=None, mmap_mode='r'):
+    # the dataset written by `flask export-siamese`, or the legacy train.npy and obj.pkl
+    if folder is None:
+        folder = dataset_dir if os.path.exists(os.path.join(dataset_dir, 'meta.json')) else cache_dir
+    if os.path.exists(os.path.join(folder, 'meta.json')):
+        return Dataset(folder).load(mmap_mode)
+    obj = pickle.load(open(os.path.join(folder, 'obj.pkl'), 'rb'))
+    return np.load(os.path.join(folder, 'train.npy'), mmap_mode=mmap_mode), obj['y_'], obj['label2id'], obj['id2label']
 
 
 def score_reshape(score, x, y=None):
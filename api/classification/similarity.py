@@ -0,0 +1,70 @@
+"""
+Full-profile library search: every reference and unknown on the shared grid is
+normalized once, then scored against the whole library with one matrix product.
+
+    cosine       x . r / (|x| |r|)
+    correlation  cosine of the mean-centered spectra (Pearson r)
+    hqi          hit quality index, cosine squared, 0 for anti-correlated spectra
+"""
+import numpy as np
+
+METRICS = ('cosine', 'correlation', 'hqi')
+MAX_DERIVATIVE = 2
+
+
+def bin_starts(dim, points):
+    # first column of each of `points` nearly equal bins over dim columns
+    return np.unique(np.linspace(0, dim, min(points, dim) + 1).astype(int)[:-1])
+
+
+def preprocess(Y, metric='cosine', derivative=0, points=None):
+    """
+    :param Y: (n, D) spectra on the shared grid
+    :param derivative: order of the finite difference taken first, 0 keeps the profile
+    :param points: number of bins the grid is summed into, None keeps every column
+    :return: float32 C-contiguous (n, points) rows of unit norm, zero rows stay zero
+    """
+    Y = np.asarray(Y, dtype=np.float32)
+    for _ in range(derivative):
+        Y = np.diff(Y, axis=1)
+    if points and points < Y.shape[1]:
+        Y = np.add.reduceat(Y, bin_starts(Y.shape[1], points), axis=1)
+    if metric == 'correlation':
+        Y = Y - Y.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(Y, axis=1, keepdims=True)
+    return np.ascontiguousarray(np.divide(Y, norm, out=np.zeros_like(Y), where=norm > 0))
+
+
+class SimilarityIndex:
+    """Normalized float32 (N, points) matrix of the library for one metric and preprocessing."""
+
+    def __init__(self, names, X, metric='cosine', derivative=0, points=None):
+        if metric not in METRICS:
+            raise ValueError(f'metric must be one of {", ".join(METRICS)}')
+        if derivative not in range(MAX_DERIVATIVE + 1):
+            raise ValueError(f'derivative must be 0 to {MAX_DERIVATIVE}')
+        self.names = list(names)
+        self.metric = metric
+        self.derivative = derivative
+        self.points = points
+        self.matrix = preprocess(X, metric, derivative, points)
+
+    def __len__(self):
+        return len(self.names)
+
+    def scores(self, Y):
+        # (n, N) similarity of n unknowns to every reference, one BLAS call
+        S = preprocess(Y, self.metric, self.derivative, self.points) @ self.matrix.T
+        if self.metric == 'hqi':
+            S = np.square(np.maximum(S, 0, out=S), out=S)
+        return S
+
+    def search(self, Y, k=10):
+        """:return: per unknown, the k best references as (name, score), best first"""
+        S = self.scores(Y)
+        k = min(k, len(self))
+        if k <= 0: return [[] for _ in range(len(S))]
+        top = np.argpartition(-S, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(S, top, axis=1), axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        return [[(self.names[j], float(s[j])) for j in row] for s, row in zip(S, top)]
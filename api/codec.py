@@ -0,0 +1,56 @@
+"""Binary encoding and content hashes of spectrum x/y arrays."""
+import hashlib
+import struct
+
+import numpy as np
+
+# magic, version, dtype ('f4' or 'f8'), number of points
+MAGIC = b'RSPC'
+VERSION = 1
+HEADER = struct.Struct('<4sB2sI')
+
+DTYPES = ('float32', 'float64')
+
+
+def encode(x, y, dtype='float64'):
+    if dtype not in DTYPES:
+        raise ValueError(f'unsupported spectrum dtype {dtype}')
+    dtype = np.dtype(dtype).newbyteorder('<')
+    xy = np.array([x, y], dtype=dtype)
+    if xy.ndim != 2:
+        raise ValueError('x and y must be 1-d and of the same length')
+    header = HEADER.pack(MAGIC, VERSION, dtype.str[1:].encode(), xy.shape[1])
+    return header + xy.tobytes()
+
+
+def decode(blob):
+    # zero-copy views into the blob, read-only
+    magic, version, code, n = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not an encoded spectrum')
+    xy = np.frombuffer(blob, dtype='<' + code.decode(), count=2 * n, offset=HEADER.size)
+    xy = xy.reshape(2, n)
+    return xy[0], xy[1]
+
+
+def content_hash(x, y):
+    # sha256 over x/y cast to float32, so text and binary copies hash the same
+    xy = np.array([x, y], dtype='<f4')
+    return hashlib.sha256(xy.tobytes()).hexdigest()
+
+
+def fingerprint(x, y, bins=64, levels=16):
+    """
+    Coarse hash that near-duplicates share: y resampled to a few bins over the
+    rounded x range, scaled to its maximum and quantized to a few levels.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    lo, hi = np.round(x.min()), np.round(x.max())
+    order = np.argsort(x, kind='stable')
+    profile = np.interp(np.linspace(lo, hi, bins), x[order], y[order])
+    scale = np.abs(profile).max()
+    if scale > 0: profile = profile / scale
+    quantized = np.round(profile * (levels - 1)).astype('<i1')
+    head = np.array([lo, hi], dtype='<f4').tobytes()
+    return hashlib.sha256(head + quantized.tobytes()).hexdigest()
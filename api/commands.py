@@ -0,0 +1,159 @@
+"""Maintenance commands, run with `flask <command>`."""
+from datetime import datetime as dt
+from functools import partial
+from multiprocessing import Pool
+import time
+
+import click
+from flask import current_app as app
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+from .models import db, Spectrum
+from . import library, shining
+
+
+def add_missing_columns(model):
+    # db.create_all only creates missing tables, not missing columns
+    table = model.__table__
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    quote = db.engine.dialect.identifier_preparer.quote
+    added = set()
+    for column in table.columns:
+        if column.name in existing: continue
+        ddl = column.type.compile(dialect=db.engine.dialect)
+        db.engine.execute(f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {ddl}')
+        click.echo(f'added column {table.name}.{column.name}')
+        added.add(column.name)
+    for index in table.indexes:
+        if added.intersection(c.name for c in index.columns):
+            index.create(db.engine)
+            click.echo(f'added index {index.name}')
+
+
+@app.cli.command('migrate-storage')
+@click.option('--dtype', default=None, help='float32 or float64, defaults to SPECTRUM_DTYPE')
+@click.option('--batch-size', default=500)
+def migrate_storage(dtype, batch_size):
+    """Move x/y of text spectrum rows into the binary blob column, hash them and store their peaks and grid row."""
+    add_missing_columns(Spectrum)
+
+    grid_spec = app.config["SPECTRUM_GRID"]
+    last_id, migrated, skipped = 0, 0, 0
+    while True:
+        rows = Spectrum.query.filter(
+            Spectrum.id > last_id,
+            db.or_(Spectrum.blob.is_(None), Spectrum.content_hash.is_(None), Spectrum.peaks.is_(None),
+                   Spectrum.features_grid.is_(None), Spectrum.features_grid != grid_spec)
+        ).order_by(Spectrum.id).limit(batch_size).all()
+        if not rows: break
+        for s in rows:
+            last_id = s.id
+            try:
+                s.set_data(s.to_data(), storage='binary', dtype=dtype)
+                if s.peaks is None: s.peaks = library.dumps_peaks(*s.xy())
+                migrated += 1
+            except (ValueError, KeyError, TypeError, AttributeError):
+                app.logger.warning(f'spectrum {s.id} has no readable x/y, skipped')
+                skipped += 1
+        db.session.commit()
+
+    if migrated: library.bump()
+    click.echo(f'{migrated} spectrums migrated, {skipped} skipped')
+
+
+@app.cli.command('export-siamese')
+@click.option('--out', default=None, help='dataset folder, defaults to siamese.config.dataset_dir')
+@click.option('--batch-size', default=1000)
+@click.option('--rebuild', is_flag=True, help='export every spectrum again instead of only new ones')
+def export_siamese(out, batch_size, rebuild):
+    """Stream the Spectrum table into the siamese training dataset, a chunk per batch."""
+    from .classification.siamese.config import dataset_dir
+    from .classification.siamese.dataset import Dataset, to_input
+    dataset = Dataset(out or dataset_dir, rebuild=rebuild)
+
+    last_id, exported, skipped = dataset.last_id, 0, 0
+    while True:
+        rows = Spectrum.query.options(
+            load_only(Spectrum.id, Spectrum.name, Spectrum.data, Spectrum.blob)
+        ).filter(Spectrum.id > last_id).order_by(Spectrum.id).limit(batch_size).all()
+        if not rows: break
+        xs, ys, names, ids = [], [], [], []
+        for s in rows:
+            last_id = s.id
+            try:
+                x, y = s.xy()
+            except (ValueError, KeyError, TypeError, AttributeError):
+                app.logger.warning(f'spectrum {s.id} has no readable x/y, skipped')
+                skipped += 1
+                continue
+            xs.append(x)
+            ys.append(y)
+            names.append(s.name)
+            ids.append(s.id)
+        dataset.append(to_input(xs, ys), names, ids, last_id=last_id)
+        exported += len(ids)
+        # keep memory flat over the whole table
+        db.session.expunge_all()
+
+    # one chunk again, so readers memory-map it instead of concatenating
+    dataset.compact()
+    click.echo(f'{exported} spectrums exported, {skipped} skipped, {len(dataset)} in {dataset.folder}')
+
+
+def insert_new(rows, seen, near=False):
+    """
+    Insert the rows whose content hash (and fingerprint if near) is neither in seen nor in
+    the table, with one executemany. seen holds the keys of the rows inserted so far.
+    :return: number of inserted rows
+    """
+    keys = ('content_hash', 'fingerprint') if near else ('content_hash',)
+    for key in keys:
+        column = getattr(Spectrum, key)
+        values = {row[key] for row in rows}
+        seen.update(value for value, in db.session.query(column).filter(column.in_(values)))
+    new = []
+    for row in rows:
+        if any(row[key] in seen for key in keys): continue
+        seen.update(row[key] for key in keys)
+        new.append(row)
+    if new:
+        db.session.execute(Spectrum.__table__.insert(), new)
+        db.session.commit()
+    return len(new)
+
+
+@app.cli.command('import-shining')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--workers', default=None, type=int, help='parser processes, defaults to the CPU count')
+@click.option('--batch-size', default=500)
+def import_shining(paths, workers, batch_size):
+    """Bulk import shining-format .txt files, or folders of them, into the Spectrum table."""
+    add_missing_columns(Spectrum)
+    files = shining.find_files(paths)
+    storage, dtype = app.config["SPECTRUM_STORAGE"], app.config["SPECTRUM_DTYPE"]
+    near = app.config["SPECTRUM_NEAR_DUPLICATES"]
+
+    t_start = time.perf_counter()
+    seen, batch, inserted, failed = set(), [], 0, 0
+    # workers only parse and encode, the inserts stay in this process
+    with Pool(workers) as pool:
+        parsed = pool.imap_unordered(partial(shining.spectrum_row, storage=storage, dtype=dtype,
+                                               grid_spec=app.config["SPECTRUM_GRID"]), files, chunksize=4)
+        for row in parsed:
+            if isinstance(row, tuple):
+                app.logger.warning(f'{row[0]}: {row[1]}, skipped')
+                failed += 1
+                continue
+            row['created'] = dt.now()
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted += insert_new(batch, seen, near)
+                batch = []
+    if batch: inserted += insert_new(batch, seen, near)
+    elapsed = time.perf_counter() - t_start
+
+    if inserted: library.bump()
+    duplicates = len(files) - inserted - failed
+    click.echo(f'{len(files)} files in {elapsed:.2f}s ({len(files) / max(elapsed, 1e-9):.1f} files/s): '
+               f'{inserted} inserted, {duplicates} duplicates, {failed} failed')
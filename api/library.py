@@ -0,0 +1,209 @@
+"""Worker-level cache of the decoded reference library."""
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from flask import current_app
+import numpy as np
+
+from .models import db, Spectrum, LibraryVersion
+from . import metrics
+from .classification import feat_peak, grid
+
+
+def dumps_peaks(x, y):
+    # serialize the peaks of one spectrum for the Spectrum.peaks column
+    peaks = feat_peak.search_peaks(x, y)
+    return json.dumps([[float(x), float(y)] for x, y in peaks])
+
+
+class Entry:
+    """Decoded x/y arrays, precomputed peaks and y on the shared grid of one spectrum."""
+
+    __slots__ = ('id', 'name', 'x', 'y', 'peaks', 'features')
+
+    def __init__(self, id, name, x, y, peaks, features):
+        self.id = id
+        self.name = name
+        self.x = x
+        self.y = y
+        self.peaks = peaks
+        self.features = features
+
+    @property
+    def nbytes(self):
+        return self.x.nbytes + self.y.nbytes + self.peaks.nbytes + self.features.nbytes
+
+
+class LibraryCache:
+    """
+    LRU cache of library entries keyed by spectrum id, valid for one library
+    version. The version lives in the database, so writes from any worker are
+    seen within `ttl` seconds, and immediately by the worker that wrote.
+    """
+
+    def __init__(self, max_bytes, ttl=5.0, grid_spec=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.grid_spec = grid_spec
+        self.grid = grid.parse_grid(grid_spec) if grid_spec else None
+        self._matrix = None
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.ids = None
+        self._version = None
+        self._checked = 0.0
+        self.hits = self.misses = self.evictions = 0
+
+    def version(self):
+        with self.lock:
+            if self._version is None or time.monotonic() - self._checked > self.ttl:
+                version = db.session.query(LibraryVersion.version).filter_by(id=1).scalar() or 0
+                if version != self._version: self.clear()
+                self._version, self._checked = version, time.monotonic()
+            return self._version
+
+    def bump(self, spectrum_id=None):
+        # called after any write to the Spectrum table
+        updated = LibraryVersion.query.filter_by(id=1).update(
+            {LibraryVersion.version: LibraryVersion.version + 1})
+        if not updated: db.session.add(LibraryVersion(id=1, version=1))
+        db.session.commit()
+        version = db.session.query(LibraryVersion.version).filter_by(id=1).scalar()
+        with self.lock:
+            if spectrum_id is not None and self._version == version - 1:
+                # only our own write since the last check
+                self.evict(int(spectrum_id))
+                self.ids = self._matrix = None
+            else:
+                self.clear()
+            self._version, self._checked = version, time.monotonic()
+
+    def evict(self, spectrum_id):
+        entry = self.entries.pop(spectrum_id, None)
+        if entry is not None: self.nbytes -= entry.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        self.ids = self._matrix = None
+
+    def get(self, ids):
+        with self.lock:
+            found, missing = {}, []
+            for i in ids:
+                if i in self.entries:
+                    self.entries.move_to_end(i)
+                    found[i] = self.entries[i]
+                else:
+                    missing.append(i)
+            self.hits += len(found)
+            self.misses += len(missing)
+
+            for entry in self.load(missing):
+                found[entry.id] = entry
+                self.put(entry)
+            return [found[i] for i in ids if i in found]
+
+    def put(self, entry):
+        self.evict(entry.id)
+        self.entries[entry.id] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def load(self, ids, chunk=1000):
+        # read only: rows stored before the peaks/features columns or on another
+        # grid are computed here and persisted by `flask migrate-storage`
+        entries = []
+        for start in range(0, len(ids), chunk):
+            rows, features = [], []
+            with metrics.span('db_load'):
+                for s in Spectrum.query.filter(Spectrum.id.in_(ids[start:start + chunk])):
+                    x, y = s.xy()
+                    peaks = dumps_peaks(x, y) if s.peaks is None else s.peaks
+                    peaks = np.array(json.loads(peaks), dtype=float).reshape(-1, 2)
+                    rows.append((s.id, s.name, x, y, peaks))
+                    if s.features is not None and s.features_grid == self.grid_spec:
+                        features.append(np.frombuffer(s.features, dtype=np.float32))
+                    else:
+                        features.append(None)
+            at = [i for i, f in enumerate(features) if f is None]
+            for i, f in zip(at, self.resample([rows[i][2] for i in at], [rows[i][3] for i in at]) if at else ()):
+                features[i] = f
+            entries.extend(Entry(*row, f) for row, f in zip(rows, features))
+        return entries
+
+    def resample(self, xs, ys):
+        with metrics.span('preprocessing'):
+            return grid.resample(xs, ys, self.grid)
+
+    def all(self):
+        self.version()
+        with self.lock:
+            if self.ids is None:
+                self.ids = [i for i, in db.session.query(Spectrum.id).order_by(Spectrum.id)]
+            return self.get(self.ids)
+
+    def matrix(self):
+        """(names, float32 (N, D) matrix of the library on the shared grid)"""
+        entries = self.all()
+        with self.lock:
+            if self._matrix is None:
+                names = [entry.name for entry in entries]
+                X = np.empty((len(entries), len(self.grid)), dtype=np.float32)
+                for i, entry in enumerate(entries):
+                    X[i] = entry.features
+                self._matrix = (names, X)
+            return self._matrix
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'version': self._version,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else None,
+            }
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = LibraryCache(current_app.config["LIBRARY_CACHE_BYTES"],
+                              current_app.config["LIBRARY_VERSION_TTL"],
+                              current_app.config["SPECTRUM_GRID"])
+    return _cache
+
+
+def get_library():
+    return get_cache().all()
+
+
+def get_matrix():
+    return get_cache().matrix()
+
+
+def resample(xs, ys):
+    # unknown spectra onto the grid of the library matrix
+    return get_cache().resample(xs, ys)
+
+
+def version():
+    return get_cache().version()
+
+
+def bump(spectrum_id=None):
+    get_cache().bump(spectrum_id)
@@ -0,0 +1,104 @@
+"""Named timing spans of the request pipeline, kept as per-worker histograms."""
+from contextlib import contextmanager
+from functools import wraps
+import bisect
+import threading
+import time
+
+# upper bounds in milliseconds, the last bucket counts everything slower
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf'))
+
+
+def bucket_label(bound):
+    # prometheus style, the catch-all bucket is "+Inf"
+    return '+Inf' if bound == float('inf') else str(bound)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank: return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_ms': self.sum,
+            'mean_ms': self.sum / self.count if self.count else None,
+            'max_ms': self.max,
+            'p50_ms': self.quantile(0.5),
+            'p99_ms': self.quantile(0.99),
+            'buckets': {bucket_label(bound): count for bound, count in zip(BUCKETS, self.counts)},
+        }
+
+
+_histograms = {}
+_lock = threading.Lock()
+_tracer = None
+
+
+def configure(config):
+    # forward spans to ddtrace as well when METRICS_DDTRACE is set and ddtrace is installed
+    global _tracer
+    if config.get("METRICS_DDTRACE"):
+        try:
+            from ddtrace import tracer
+            _tracer = tracer
+        except ImportError:
+            _tracer = None
+
+
+def observe(name, ms):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None: histogram = _histograms[name] = Histogram()
+        histogram.observe(ms)
+
+
+@contextmanager
+def span(name):
+    trace = _tracer.trace(name, service='sit-raman') if _tracer else None
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - t_start) * 1000)
+        if trace: trace.finish()
+
+
+def timed(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        return {name: histogram.to_dict() for name, histogram in sorted(_histograms.items())}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
@@ -1,8 +1,41 @@
 """Data models."""
-from . import db
+from flask import current_app
+import numpy as np
+
+from . import db, codec
+from .classification import grid
 
 import json
 
+
+def loads_data(text):
+    # legacy rows hold the python repr of the request dict
+    try:
+        return json.loads(text)
+    except ValueError:
+        return json.loads(text.replace("'", '"'))
+
+
+def grid_columns(x, y, spec):
+    # float32 y on the shared grid "start,stop,num", loaded by the library cache as is
+    row = grid.resample([x], [y], grid.parse_grid(spec))[0]
+    return {'features': row.tobytes(), 'features_grid': spec}
+
+
+def encode_columns(data, storage, dtype, grid_spec=None):
+    # data, blob, hash and grid row columns of a Spectrum for a data dict with x/y, no app context needed
+    columns = {'content_hash': codec.content_hash(data['x'], data['y']),
+               'fingerprint': codec.fingerprint(data['x'], data['y'])}
+    if storage == "text":
+        columns.update(data=f'{data}', blob=None)
+    else:
+        columns.update(blob=codec.encode(data['x'], data['y'], dtype),
+                       data=json.dumps({k: v for k, v in data.items() if k not in ('x', 'y')}))
+    if grid_spec:
+        columns.update(grid_columns(data['x'], data['y'], grid_spec))
+    return columns
+
+
 class User(db.Model):
     """Data model for user accounts."""
 
@@ -27,6 +60,16 @@ class Spectrum(db.Model):
     cas = db.Column(db.String(80), index=False, unique=False, nullable=True)
     created = db.Column(db.DateTime, index=False, unique=False, nullable=False)
     data = db.Column(db.Text, index=False, unique=False, nullable=True)
+    # x/y encoded by api.codec, data then only keeps the other keys
+    blob = db.Column(db.LargeBinary(2 ** 24), index=False, unique=False, nullable=True)
+    # api.codec.content_hash / fingerprint of x/y, for indexed dedup
+    content_hash = db.Column(db.String(64), index=True, unique=False, nullable=True)
+    fingerprint = db.Column(db.String(64), index=True, unique=False, nullable=True)
+    # json list of [x, y] peaks, precomputed at create/update time
+    peaks = db.Column(db.Text, index=False, unique=False, nullable=True)
+    # float32 y on the SPECTRUM_GRID stored in features_grid, precomputed at create/update time
+    features = db.Column(db.LargeBinary(2 ** 24), index=False, unique=False, nullable=True)
+    features_grid = db.Column(db.String(64), index=False, unique=False, nullable=True)
     description = db.Column(db.Text, index=False, unique=False, nullable=True)
     ideal_chemistry = db.Column(db.Text, index=False, unique=False, nullable=True)
     measured_chemistry = db.Column(db.Text, index=False, unique=False, nullable=True)
@@ -39,11 +82,60 @@ class Spectrum(db.Model):
     # owner = db.Column(db.Text, index=False, unique=False, nullable=True)
     # url = db.Column(db.Text, index=False, unique=False, nullable=True)
     
+    def set_data(self, data, storage=None, dtype=None):
+        storage = storage or current_app.config["SPECTRUM_STORAGE"]
+        if storage != "text": dtype = dtype or current_app.config["SPECTRUM_DTYPE"]
+        grid_spec = current_app.config["SPECTRUM_GRID"]
+        for column, value in encode_columns(data, storage, dtype, grid_spec).items():
+            setattr(self, column, value)
+
+    def xy(self):
+        if self.blob is not None:
+            return codec.decode(self.blob)
+        data = loads_data(self.data)
+        return np.asarray(data['x'], dtype=float), np.asarray(data['y'], dtype=float)
+
+    def to_data(self):
+        data = loads_data(self.data) if self.data else {}
+        if self.blob is not None:
+            x, y = codec.decode(self.blob)
+            data = dict(x=x.tolist(), y=y.tolist(), **data)
+        return data
+
+    def data_text(self):
+        # the data column as stored before the blob column, the python repr of the data dict
+        return self.data if self.blob is None else f'{self.to_data()}'
+
+    @classmethod
+    def data_filter(cls, text):
+        # rows whose data_text is `text`, binary rows are matched by the content hash of its x/y
+        match = cls.data == text
+        try:
+            data = loads_data(text)
+            match = db.or_(match, cls.content_hash == codec.content_hash(data['x'], data['y']))
+        except (ValueError, KeyError, TypeError):
+            pass
+        return match
+
+    def find_duplicate(self, near=False):
+        # single indexed lookup, near also matches the quantized fingerprint
+        match = Spectrum.content_hash == self.content_hash
+        if near: match = db.or_(match, Spectrum.fingerprint == self.fingerprint)
+        return Spectrum.query.filter(match).first()
+
     def __repr__(self):
         # return "<Spectrum {} {}>".format(self.name, self.id)
-        return json.dumps({'name': self.name, 'cas': self.cas, 'data': self.data})
+        return json.dumps({'name': self.name, 'cas': self.cas, 'data': self.data_text()})
     
     
+class LibraryVersion(db.Model):
+    """Counter bumped on every write to the spectrum library."""
+
+    __tablename__ = "sit-raman-library"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, index=False, unique=False, nullable=False, default=0)
+
+
 class Bio_Spectrum(Spectrum):
     """Data model for user bio spectrum."""
     
@@ -0,0 +1,44 @@
+"""Worker-level index of precomputed reference peaks."""
+import threading
+
+from flask import current_app
+
+from . import library, metrics
+from .classification.matcher import PeakMatcher
+from .classification.prefilter import PeakBinIndex
+
+# PeakMatcher over the cached library and its bin index, rebuilt when the library version changes
+_matcher = None
+_prefilter = None
+_version = None
+_lock = threading.Lock()
+
+
+def get_index():
+    # {name: [(x, y), ...]}
+    return {entry.name: entry.peaks for entry in library.get_library()}
+
+
+def get_matchers():
+    """
+    (PeakMatcher, PeakBinIndex or None) of one library version, use both from
+    one call so the candidate indices belong to that matcher.
+    """
+    global _matcher, _prefilter, _version
+    version = library.version()
+    with _lock:
+        if _matcher is None or _version != version:
+            index = get_index()
+            with metrics.span('matcher_build'):
+                _matcher, _prefilter, _version = PeakMatcher(index), None, version
+        if _prefilter is None and current_app.config["PEAK_CANDIDATES"]:
+            with metrics.span('prefilter_build'):
+                _prefilter = PeakBinIndex.from_matcher(_matcher, current_app.config["PEAK_BIN_WIDTH"])
+        return _matcher, _prefilter if current_app.config["PEAK_CANDIDATES"] else None
+
+
+def candidates(prefilter, peaks):
+    """Key indices of the prefilter's matcher to compare peaks with, None for the whole library."""
+    if prefilter is None: return None
+    with metrics.span('prefilter'):
+        return prefilter.candidates(peaks, current_app.config["PEAK_CANDIDATES"])
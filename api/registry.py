@@ -0,0 +1,236 @@
+"""Train-once, serve-many registry of classifiers fitted on the library."""
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import current_app
+import joblib
+import numpy as np
+
+from . import library, metrics
+from .classification import random_forest, boosting
+
+# fit runs in executor threads without an app context, "api.registry" propagates to app.logger
+logger = logging.getLogger(__name__)
+
+BUILDERS = {'rf': random_forest.rf_model, 'boosting': boosting.gbt_model}
+
+
+def training_data():
+    # library resampled on the shared grid, see library.get_matrix
+    names, X = library.get_matrix()
+    return X, names
+
+
+class ModelRegistry:
+    """
+    Models are fitted once per library version in a background thread and
+    saved as `<method>-<version>.joblib`. Every worker memory-maps the file, and
+    until the model for a new version is ready the previous one keeps serving.
+    A `.lock` file next to it keeps workers from fitting the same model twice,
+    the others wait for its file. Fits start as soon as a write changes the
+    library version, see refit.
+    """
+
+    def __init__(self, folder, lock_timeout=3600):
+        self.folder = folder
+        self.lock_timeout = lock_timeout
+        os.makedirs(folder, exist_ok=True)
+        self.models = {}   # method -> (version, model)
+        self.pending = {}  # method -> (version, future)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def path(self, method, version):
+        return os.path.join(self.folder, f'{method}-{version}.joblib')
+
+    def saved_versions(self, method):
+        versions = []
+        for path in glob.glob(os.path.join(self.folder, f'{method}-*.joblib')):
+            match = re.search(r'-(\d+)\.joblib$', path)
+            if match: versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def load(self, method, version):
+        with metrics.span('model_load'):
+            model = joblib.load(self.path(method, version), mmap_mode='r')
+        previous = self.models.get(method)
+        self.models[method] = (version, model)
+        # only files older than the one served until now go: that one may still be the
+        # newest saved model of another worker, mapped copies stay valid after unlink
+        if previous:
+            for old in self.saved_versions(method):
+                if old < previous[0]:
+                    try:
+                        os.remove(self.path(method, old))
+                    except OSError:
+                        pass
+        return model
+
+    def load_newest(self, method):
+        # (model, version) of the newest saved file, None when there is none
+        for version in reversed(self.saved_versions(method)):
+            try:
+                return self.load(method, version), version
+            except FileNotFoundError:
+                continue  # removed by another worker meanwhile
+        return None
+
+    def get(self, method, version, load_data=training_data):
+        """
+        :return: (model, version it was fitted on), the newest model available
+                 while the one for `version` is fitted in the background.
+        """
+        if method not in BUILDERS:
+            raise ValueError(f'unknown model {method}')
+        with self.lock:
+            cached = self.models.get(method)
+            if cached and cached[0] == version:
+                return cached[1], version
+            if os.path.exists(self.path(method, version)):
+                return self.load(method, version), version
+
+            future = self.submit(method, version, load_data)
+            if cached:
+                return cached[1], cached[0]
+            newest = self.load_newest(method)
+            if newest:
+                return newest
+
+        # cold start, nothing to serve yet: wait for our fit or for the worker holding the lock
+        while True:
+            if future is None:
+                self.wait(method, version)
+            else:
+                try:
+                    future.result()
+                except CancelledError:
+                    pass  # superseded by the fit of a newer version
+            with self.lock:
+                newest = self.load_newest(method)
+                if newest:
+                    return newest
+                # the other worker gave up without a file
+                future = self.submit(method, version, load_data)
+
+    def refit(self, version, load_data=training_data):
+        """Start fitting the models in use, here or by any worker, on a new library version."""
+        with self.lock:
+            for method in BUILDERS:
+                if method in self.models or self.saved_versions(method):
+                    self.submit(method, version, load_data)
+
+    def wait(self, method, version, poll=0.5):
+        # until the worker holding the lock of this fit saved it or gave up
+        lock = self.path(method, version) + '.lock'
+        while not os.path.exists(self.path(method, version)):
+            try:
+                if time.time() - os.path.getmtime(lock) >= self.lock_timeout: return
+            except OSError:
+                return  # lock removed
+            time.sleep(poll)
+
+    def submit(self, method, version, load_data):
+        pending = self.pending.get(method)
+        if pending and not pending[1].done():
+            if pending[0] >= version:
+                return pending[1]
+            # a newer version supersedes a fit that has not started yet
+            stale = self.path(method, pending[0]) + '.lock'
+            if pending[1].cancel() and os.path.exists(stale): os.remove(stale)
+        lock = self.path(method, version) + '.lock'
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) < self.lock_timeout:
+                    return None  # another worker is fitting it
+                os.utime(lock)
+            except OSError:
+                return None  # just released, its file is about to show up
+        # the background thread reads the data in an app context of its own
+        future = self.executor.submit(self.fit_in_context, current_app._get_current_object(),
+                                      method, version, load_data, lock)
+        self.pending[method] = (version, future)
+        return future
+
+    def fit_in_context(self, app, method, version, load_data, lock):
+        try:
+            with app.app_context():
+                X, Y = load_data()
+        except Exception:
+            if os.path.exists(lock): os.remove(lock)
+            logger.exception(f'reading the library for {method} failed')
+            raise
+        try:
+            return self.fit(method, version, X, Y, lock)
+        except Exception:
+            logger.exception(f'fitting {method} on library version {version} failed')
+            raise
+
+    def fit(self, method, version, X, Y, lock=None):
+        try:
+            t_start = time.time()
+            model = BUILDERS[method]()
+            with metrics.span('model_fit'):
+                model.fit(X, Y)
+            path = self.path(method, version)
+            tmp = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+            joblib.dump(model, tmp)
+            os.replace(tmp, path)
+            logger.info(f'fitted {method} on library version {version} in {time.time() - t_start:.2f}s')
+        finally:
+            if lock and os.path.exists(lock): os.remove(lock)
+        return model
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        # models only fit the grid they were trained on
+        grid = current_app.config["SPECTRUM_GRID"].replace(',', '-')
+        _registry = ModelRegistry(os.path.join(current_app.config["MODEL_DIR"], grid))
+    return _registry
+
+
+def refit(version):
+    # called after a write, so the models are ready before the next prediction
+    get_registry().refit(version)
+
+
+def predict(method, sample):
+    result = predict_batch(method, [sample])[0]
+    if isinstance(result, Exception): raise result
+    return result
+
+
+def predict_batch(method, samples):
+    """
+    One predict_proba over the (N, D) matrix of samples. Samples that don't
+    have the model's D features get a ValueError in their place.
+    """
+    model, version = get_registry().get(method, library.version())
+    n_features = model.n_features_in_
+    results = [ValueError(f'expected {n_features} points, got {len(sample)}')
+               for sample in samples]
+    valid = [i for i, sample in enumerate(samples) if len(sample) == n_features]
+    if not valid:
+        return results
+
+    with metrics.span('model_predict'):
+        proba = model.predict_proba(np.array([samples[i] for i in valid], dtype=np.float32))
+    best = proba.argmax(axis=1)
+    for i, label, p in zip(valid, model.classes_[best], proba[np.arange(len(best)), best]):
+        results[i] = {
+            'prediction': label,
+            'probability': float(p),
+            'library_version': version,
+        }
+    return results
@@ -1,7 +1,6 @@
 """Application routes."""
 from operator import itemgetter
 from datetime import datetime as dt
-import pandas as pd
 import numpy as np
 import json
 
@@ -11,8 +10,9 @@ from flask import make_response, redirect, render_template, request, url_for, js
 from flask_api import status
 
 from .models import User, db, Spectrum
+from . import library, metrics, peak_index, registry, siamese_service, similarity_index
 
-from .classification import random_forest, boosting, feat_peak, siamese
+from .classification import feat_peak
 
 
 @app.route("/user", methods=["GET"])
@@ -114,19 +114,21 @@ def create_one_spectrum():
     name, data = itemgetter('name', 'data')(req)
     print(name)
     if 'x' in data and 'y' in data and data['x'] and data['y']:
-        existing_spectrum = Spectrum.query.filter(
-            Spectrum.data == f'{data}'
-            # Spectrum.name == name
-        ).first()
-        if existing_spectrum: return make_response(f"{name} already created!")
         new_spectrum = Spectrum(
             name=name,
             created=dt.now(),
-            data=f'{data}'
+            peaks=library.dumps_peaks(data['x'], data['y'])
             # **req
         )
+        new_spectrum.set_data(data)
+        existing_spectrum = new_spectrum.find_duplicate(
+            near=app.config["SPECTRUM_NEAR_DUPLICATES"]
+        )
+        if existing_spectrum: return make_response(f"{name} already created!")
         db.session.add(new_spectrum)
         db.session.commit()
+        library.bump(new_spectrum.id)
+        registry.refit(library.version())
         return jsonify(status=201, message='created')
     return bad_request('')
 
@@ -161,9 +163,9 @@ def query_spectrums():
     # arg set
     exist_spectrums = set()
     for key in request.args.keys():
-        exist_spectrum = Spectrum.query.filter(
+        match = Spectrum.data_filter(request.args[key]) if key == 'data' else \
             getattr(Spectrum, key) == request.args[key]
-        ).all()
+        exist_spectrum = Spectrum.query.filter(match).all()
         for spectrum in exist_spectrum: exist_spectrums.add(spectrum)
 
     if len(exist_spectrums):
@@ -188,8 +190,11 @@ def update_one_spectrum(id):
     if exist_spectrum:
         exist_spectrum.name = name
         exist_spectrum.cas = cas
-        exist_spectrum.data = f'{data}'
+        exist_spectrum.set_data(data)
+        exist_spectrum.peaks = library.dumps_peaks(data['x'], data['y'])
         db.session.commit()
+        library.bump(id)
+        registry.refit(library.version())
         return jsonify(status=200, message='updated')
     else:
         return not_found('')
@@ -202,47 +207,154 @@ def delete_one_spectrum(id):
     if exist_spectrum:
         db.session.delete(exist_spectrum)
         db.session.commit()
+        library.bump(id)
+        registry.refit(library.version())
         return jsonify(status=200, message='deleted')
     else:
         return not_found('')
 
 
+def _respond(message):
+    with metrics.span('serialization'):
+        return jsonify(status=200, message=message)
+
+
 @app.route('/spectrum/classification', methods=['POST'])
+@metrics.timed('classification')
 def classify_spectrum():
-    spectrum = request.get_json()
+    with metrics.span('json_decode'):
+        spectrum = request.get_json()
 
     # unknow
-    data = f'{itemgetter("data")(spectrum)}'
+    data = itemgetter("data")(spectrum)
     method = ''
     if 'method' in spectrum: method = spectrum['method']
 
-    # known
-    spectrums = Spectrum.query.all()
-
-    # 默认方法
+    # 默认方法, only needs the precomputed peak index
     if not method or method == '':
-        all_spectrums = {}
-        for s in spectrums:
-            _s = json.loads(s.data.replace("'", '"'))
-            all_spectrums[s.name] = [_s['x'], _s['y']]
-        result = feat_peak.classify(data['x'], data['y'], all_spectrums)
-
-    # load known spectrum data
-    X, Y = [], []
-    for s in spectrums:
-        _s = json.loads(s.data.replace("'", '"'))
-        X.append(_s['y'])
-        Y.append(s.name)
-    X = pd.DataFrame(X)
-    sample = np.array(data['y'])[None, :]
-
-    if method == 'rf':
-        result = random_forest.rf_clf(sample, (X, Y))
-
-    elif method == 'boosting':
-        result = boosting.gbt_clf(sample, (X, Y))
+        matcher, prefilter = peak_index.get_matchers()
+        with metrics.span('peak_search'):
+            peaks = feat_peak.search_peaks(data['x'], data['y'])
+        candidates = peak_index.candidates(prefilter, peaks)
+        with metrics.span('matching'):
+            result = feat_peak.compare_peaks(matcher, peaks, candidates=candidates)
+        return _respond(result)
+
+    # fitted once per library version, see api.registry
+    if method in ('rf', 'boosting'):
+        sample = library.resample([data['x']], [data['y']])[0]
+        result = registry.predict(method, sample)
+        app.logger.info(f"{method} prediction from library version {result['library_version']}")
+
+    # loaded on first use and kept warm, see api.siamese_service
+    elif method == 'siamese':
+        result = siamese_service.classify(data['x'], data['y'])
+
+    # full-profile match against the normalized library matrix, see api.similarity_index
+    elif method == 'similarity':
+        try:
+            result = similarity_index.search([data['x']], [data['y']], **_similarity_options(spectrum))[0]
+        except ValueError as error:
+            return bad_request(error)
+
+    # non-negative least squares over screened candidates, see classification.mixture
+    elif method == 'mixture':
+        try:
+            result = similarity_index.decompose([data['x']], [data['y']], **_mixture_options(spectrum))[0]
+        except ValueError as error:
+            return bad_request(error)
 
     else:
-        method_not_supported('')
+        return method_not_supported('')
+
+    return _respond(result)
+
+
+def _similarity_options(req):
+    # optional "metric", "derivative" and "top_k" of a similarity request
+    return {'metric': req.get('metric') or 'cosine',
+            'derivative': int(req.get('derivative') or 0),
+            'k': int(req.get('top_k') or 0) or None}
+
+
+def _mixture_options(req):
+    # optional "candidates" and "min_fraction" of a mixture request, ValueError when out of range
+    candidates = None if req.get('candidates') is None else int(req['candidates'])
+    if candidates is not None and candidates < 1:
+        raise ValueError('candidates must be at least 1')
+    min_fraction = None if req.get('min_fraction') is None else float(req['min_fraction'])
+    if min_fraction is not None and not 0 <= min_fraction < 1:
+        raise ValueError('min_fraction must be in [0, 1)')
+    return {'candidates': candidates, 'min_fraction': min_fraction}
+
+
+def _item_result(result):
+    # per-item status of a batch response
+    if isinstance(result, Exception):
+        return {'status': status.HTTP_400_BAD_REQUEST, 'error': str(result)}
+    return {'status': status.HTTP_200_OK, 'result': result}
+
+
+@app.route('/spectrum/classification/batch', methods=['POST'])
+@metrics.timed('classification_batch')
+def classify_spectrum_batch():
+    with metrics.span('json_decode'):
+        req = request.get_json()
+
+    # unknows, results keep the request order
+    spectra = itemgetter("data")(req)
+    method = req.get('method') or ''
+
+    results = [None] * len(spectra)
+    valid = []
+    for i, data in enumerate(spectra):
+        try:
+            x, y = np.asarray(data['x'], dtype=float), np.asarray(data['y'], dtype=float)
+            if x.ndim != 1 or x.shape != y.shape or not len(x):
+                raise ValueError('x and y must be non-empty lists of the same length')
+            valid.append((i, x, y))
+        except KeyError as error:
+            results[i] = ValueError(f'missing {error}')
+        except (TypeError, ValueError) as error:
+            results[i] = error
+
+    # one matcher pass or one predict over all valid spectra
+    if not method:
+        matcher, prefilter = peak_index.get_matchers()
+        with metrics.span('peak_search_matching'):
+            outputs = feat_peak.classify_batch([(x, y) for _, x, y in valid], matcher,
+                                               prefilter, app.config["PEAK_CANDIDATES"])
+    elif method in ('rf', 'boosting'):
+        samples = library.resample([x for _, x, _ in valid], [y for _, _, y in valid])
+        outputs = registry.predict_batch(method, list(samples))
+    elif method == 'siamese':
+        outputs = siamese_service.classify_batch([x for _, x, _ in valid], [y for _, _, y in valid])
+    elif method == 'similarity':
+        try:
+            outputs = similarity_index.search([x for _, x, _ in valid], [y for _, _, y in valid],
+                                              **_similarity_options(req))
+        except ValueError as error:
+            return bad_request(error)
+    elif method == 'mixture':
+        try:
+            outputs = similarity_index.decompose([x for _, x, _ in valid], [y for _, _, y in valid],
+                                                 **_mixture_options(req))
+        except ValueError as error:
+            return bad_request(error)
+    else:
+        return method_not_supported('')
+
+    for (i, _, _), output in zip(valid, outputs):
+        results[i] = output
+    return _respond([_item_result(result) for result in results])
+
+
+@app.route('/library/stats', methods=['GET'])
+def library_stats():
+    return jsonify(status=200, message=library.get_cache().stats())
+
 
-    return jsonify(status=200, message=result)
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # timing histograms of this worker, see api.metrics
+    return jsonify(status=200, message={'buckets_ms': [metrics.bucket_label(b) for b in metrics.BUCKETS], 'spans': metrics.snapshot()})
@@ -0,0 +1,78 @@
+"""Reader of shining-format spectrum files, see ref/shiningspectrum/database.py."""
+import glob
+import os
+import re
+
+import numpy as np
+
+NUMBER = rb'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+# a data row: x and y first on the line, separated by blanks, commas or semicolons
+ROW = re.compile(rb'^[ \t]*(' + NUMBER + rb')[ \t,;]+(' + NUMBER + rb')(?:[ \t,;][^\n]*)?\r?$', re.M)
+
+
+def find_files(paths, pattern='*.txt'):
+    # files as given, folders expanded to their pattern files
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            files.append(path)
+    return files
+
+
+def parse(raw):
+    """
+    :param raw: bytes of a shining file. The #shining_header/#shining_data/#shining_end
+                markers are optional and matched in any case, rows may be separated by
+                tabs, blanks or commas, lines of other text are skipped.
+    :return: (header dict, x, y), x/y of the longest run of consecutive data rows
+    """
+    lower = raw.lower()
+    header_at = lower.find(b'#shining_header')
+    data_at = lower.find(b'#shining_data')
+    end_at = lower.find(b'#shining_end', max(data_at, 0))
+    body = raw[max(data_at, 0):end_at if end_at >= 0 else len(raw)]
+
+    # runs of rows with nothing but line breaks between them
+    best, run, last_end = (0, 0), None, None
+    matches = list(ROW.finditer(body))
+    for i, match in enumerate(matches):
+        if last_end is None or body[last_end:match.start()].strip():
+            run = i
+        last_end = match.end()
+        if i + 1 - run > best[1] - best[0]: best = (run, i + 1)
+    if best[1] - best[0] < 2:
+        raise ValueError('no x/y data rows')
+    xy = np.array([match.groups() for match in matches[best[0]:best[1]]], dtype=float)
+
+    header = {}
+    if header_at >= 0 and data_at > header_at:
+        text = raw[header_at:data_at].decode('utf-8', errors='replace')
+        for line in text.splitlines()[1:]:
+            key, sep, value = line.lstrip('#').partition(':')
+            if sep: header[key.strip()] = value.strip()
+    return header, xy[:, 0], xy[:, 1]
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return parse(f.read())
+
+
+def spectrum_row(path, storage, dtype, grid_spec=None):
+    """
+    Column values of a Spectrum row for one file, computed in an import worker.
+    Errors are returned as (path, message) instead of raised.
+    """
+    from .library import dumps_peaks
+    from .models import encode_columns
+    try:
+        header, x, y = read(path)
+        header = {k: v for k, v in header.items() if v and v != 'Not entered'}
+        cas = header.get('CAS')
+        row = encode_columns(dict(header, x=x.tolist(), y=y.tolist()), storage, dtype, grid_spec)
+        row.update(name=os.path.splitext(os.path.basename(path))[0][:64], cas=cas, peaks=dumps_peaks(x, y))
+        return row
+    except (OSError, ValueError) as error:
+        return path, str(error)
@@ -0,0 +1,172 @@
+"""Warm siamese model per worker, fed by a micro-batching queue."""
+from concurrent.futures import Future
+import os
+import queue
+import shutil
+import threading
+import time
+
+from flask import current_app
+import numpy as np
+
+from . import library, metrics
+
+
+class MicroBatcher:
+    """
+    Requests from concurrent threads are queued and run together: one thread
+    takes up to `max_batch` items, waiting at most `max_wait` seconds for the
+    batch to fill, and calls `fn(items)` once for all of them.
+    """
+
+    def __init__(self, fn, max_batch=64, max_wait=0.005):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0: break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                results = self.fn([item for item, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+
+
+class SiameseService:
+    """
+    siamese.h5 loaded once, on the first siamese request, by the batching thread
+    which then makes every model call, so keras never runs on two threads.
+    Library embeddings are rebuilt when the library version changes and saved
+    under `folder`, see siamese.index.EmbeddingIndex.
+    """
+
+    def __init__(self, model_path, folder, k=10, max_batch=64, max_wait=0.005):
+        self.model_path = model_path
+        self.folder = folder
+        self.k = k
+        self.models = None
+        self.model_mtime = None
+        self.index = None  # (library version, EmbeddingIndex)
+        self.references = None  # (library version, names, (N, 128) inputs)
+        self.lock = threading.Lock()
+        self.batcher = MicroBatcher(self.run_batch, max_batch, max_wait)
+
+    @metrics.timed('model_load')
+    def load(self):
+        from .classification.siamese.model import build_model
+        mtime = os.path.getmtime(self.model_path)
+        model, branch_model, head_model = build_model(64e-5, 0)
+        model.load_weights(self.model_path)
+        # first predict builds the graphs, requests only hit warm models
+        features = branch_model.predict(np.zeros((1,) + branch_model.input_shape[1:]), verbose=0)
+        head_model.predict([features, features], verbose=0)
+        self.models = branch_model, head_model
+        self.model_mtime = mtime
+        # library embeddings of the previous weights are refreshed on the next batch
+        self.index = None
+
+    def set_references(self, version, get_entries):
+        # called in the request thread, which has the app context for the library
+        with self.lock:
+            if self.references is None or self.references[0] != version:
+                from .classification.siamese.dataset import to_input
+                entries = get_entries()
+                self.references = (version, [e.name for e in entries],
+                                   to_input([e.x for e in entries], [e.y for e in entries]))
+            return self.references
+
+    def get_index(self, references):
+        from .classification.siamese.index import EmbeddingIndex
+        version, names, data = references
+        if self.index is None or self.index[0] != version:
+            folder = os.path.join(self.folder, f'siamese-{version}-{int(self.model_mtime)}')
+            index = EmbeddingIndex.load(folder, data)
+            if index is None:
+                with metrics.span('embedding_build'):
+                    index = EmbeddingIndex.build(self.models[0], data, names)
+                os.makedirs(self.folder, exist_ok=True)
+                index.save(folder)
+            self.remove_stale(version)
+            self.index = (version, index)
+        return self.index[1]
+
+    def remove_stale(self, version):
+        # indexes of older library versions only, other workers may still serve the current one
+        for name in os.listdir(self.folder):
+            parts = name.split('-')
+            if parts[0] != 'siamese' or len(parts) < 3 or not parts[1].isdigit(): continue
+            if int(parts[1]) < version:
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    def run_batch(self, samples):
+        # siamese.h5 is reloaded after a retraining, see siamese.incremental
+        if self.models is None or os.path.getmtime(self.model_path) != self.model_mtime: self.load()
+        with self.lock:
+            references = self.references
+        if not len(references[1]):
+            raise ValueError('the library is empty')
+        index = self.get_index(references)
+        branch_model, head_model = self.models
+        with metrics.span('model_predict'):
+            ranked = index.classify(branch_model, head_model, np.array(samples), self.k)
+        results = []
+        for candidates in ranked:
+            label, score = candidates[0]
+            results.append({
+                'prediction': label,
+                'probability': score,
+                'candidates': candidates,
+                'library_version': references[0],
+            })
+        return results
+
+    def classify_batch(self, xs, ys):
+        from .classification.siamese.dataset import to_input
+        self.set_references(library.version(), library.get_library)
+        with metrics.span('preprocessing'):
+            samples = to_input(xs, ys)
+        futures = [self.batcher.submit(sample) for sample in samples]
+        return [future.result() for future in futures]
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            config = current_app.config
+            _service = SiameseService(config["SIAMESE_MODEL"], config["MODEL_DIR"],
+                                      config["SIAMESE_TOP_K"], config["SIAMESE_BATCH_SIZE"],
+                                      config["SIAMESE_BATCH_WAIT"])
+    return _service
+
+
+def classify(x, y):
+    return get_service().classify_batch([x], [y])[0]
+
+
+def classify_batch(xs, ys):
+    return get_service().classify_batch(xs, ys)
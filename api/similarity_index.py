@@ -0,0 +1,47 @@
+"""Worker-level similarity indexes over the cached library matrix, see classification.similarity."""
+import threading
+
+from flask import current_app
+
+from . import library, metrics
+from .classification import mixture
+from .classification.similarity import SimilarityIndex
+
+# one index per (metric, derivative), all dropped when the library version changes
+_indexes = {}
+_version = None
+_lock = threading.Lock()
+
+
+def get_index(metric='cosine', derivative=0):
+    global _version
+    version = library.version()
+    with _lock:
+        if _version != version:
+            _indexes.clear()
+            _version = version
+        key = (metric, derivative)
+        if key not in _indexes:
+            names, X = library.get_matrix()
+            with metrics.span('similarity_build'):
+                _indexes[key] = SimilarityIndex(names, X, metric, derivative,
+                                                current_app.config["SIMILARITY_POINTS"])
+        return _indexes[key]
+
+
+def search(xs, ys, metric='cosine', derivative=0, k=None):
+    """:return: per spectrum, the top k library matches as (name, score)"""
+    index = get_index(metric, derivative)
+    samples = library.resample(xs, ys)
+    with metrics.span('similarity_search'):
+        return index.search(samples, k or current_app.config["SIMILARITY_TOP_K"])
+
+
+def decompose(xs, ys, candidates=None, min_fraction=None):
+    """:return: per spectrum, the library compounds of the mixture with their fractions"""
+    index = get_index('cosine', 0)
+    samples = library.resample(xs, ys)
+    with metrics.span('mixture_decomposition'):
+        return mixture.decompose(index, samples,
+                                 candidates or current_app.config["MIXTURE_CANDIDATES"],
+                                 current_app.config["MIXTURE_MIN_FRACTION"] if min_fraction is None else min_fraction)
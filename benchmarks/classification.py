@@ -0,0 +1,175 @@
+"""
+Latency, throughput and peak memory of the classification methods on synthetic
+libraries built from the shining files in data/, written as JSON.
+
+    python benchmarks/classification.py --sizes 100 1000 --out bench.json
+
+Every (method, library size) case runs in its own process, so peak RSS is that
+of the case alone.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'ref')]
+
+METHODS = ('feat_peak', 'peak_assignment', 'rf_clf', 'gbt_clf', 'siamese')
+
+
+def perturb(x, y, rng):
+    # another measurement of the same compound: shifted, scaled, noisy, on a baseline
+    x = x + rng.normal(0, 1.0)
+    y = y * rng.uniform(0.7, 1.3)
+    y = y + rng.normal(0, 0.01 * np.abs(y).max(), len(y))
+    y = y + rng.uniform(0, 0.05 * np.abs(y).max()) * np.linspace(0, 1, len(y))
+    return x, y
+
+
+def synthetic_library(size, queries, seed=0, folder=os.path.join(ROOT, 'data')):
+    """
+    :return: library and queries as lists of (label, x, y), labels are the data/ file names
+    """
+    rng = np.random.default_rng(seed)
+    from api import shining
+    bases = [(os.path.basename(path)[:-4], *shining.read(path)[1:]) for path in sorted(glob.glob(os.path.join(folder, '*.txt')))]
+    library = [(name, *perturb(x, y, rng)) for name, x, y in (bases[i % len(bases)] for i in range(size))]
+    picks = rng.integers(0, min(size, len(bases)), queries)
+    return library, [(bases[i][0], *perturb(bases[i][1], bases[i][2], rng)) for i in picks]
+
+
+def setup(method, library):
+    """:return: classify(x, y) for one query, built outside the timed loop"""
+    if method == 'feat_peak':
+        from api.classification import feat_peak
+        from api.classification.matcher import PeakMatcher
+        matcher = PeakMatcher({f'{i}-{name}': feat_peak.search_peaks(x, y) for i, (name, x, y) in enumerate(library)})
+        return lambda x, y: feat_peak.classify(x, y, matcher)
+
+    if method == 'peak_assignment':
+        from shiningspectrum import shiningnoodles
+        compounds = [{'title': f'{i}-{name}', 'x': x, 'y': y} for i, (name, x, y) in enumerate(library)]
+        testing = shiningnoodles.component_testing()
+        return lambda x, y: testing.peak_assignment({'x': x, 'y': y}, compounds)
+
+    from api.classification import grid
+    points = grid.parse_grid('50,3500,3451')
+    names = [name for name, _, _ in library]
+
+    if method in ('rf_clf', 'gbt_clf'):
+        from api.classification import random_forest, boosting
+        clf = random_forest.rf_clf if method == 'rf_clf' else boosting.gbt_clf
+        X = grid.resample([x for _, x, _ in library], [y for _, _, y in library], points)
+        # fitted on every call, as the functions do
+        return lambda x, y: clf(grid.resample([x], [y], points), (X, names))
+
+    if method == 'siamese':
+        from api.classification.siamese.config import model_path
+        from api.classification.siamese.dataset import to_input
+        from api.classification.siamese.index import EmbeddingIndex
+        from api.classification.siamese.model import build_model
+        model, branch_model, head_model = build_model(64e-5, 0)
+        if os.path.exists(model_path): model.load_weights(model_path)
+        index = EmbeddingIndex.build(branch_model, to_input([x for _, x, _ in library], [y for _, _, y in library]), names)
+        return lambda x, y: index.classify(branch_model, head_model, to_input([x], [y]))
+
+    raise ValueError(f'unknown method {method}')
+
+
+def run_case(method, size, queries, seed=0):
+    library, unknowns = synthetic_library(size, queries, seed)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        t_start = time.perf_counter()
+        classify = setup(method, library)
+        setup_s = time.perf_counter() - t_start
+        classify(*unknowns[0][1:])  # warm up
+        latencies = []
+        t_start = time.perf_counter()
+        for _, x, y in unknowns:
+            t = time.perf_counter()
+            classify(x, y)
+            latencies.append(time.perf_counter() - t)
+        total = time.perf_counter() - t_start
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    latencies = np.array(latencies) * 1000
+    return {
+        'method': method,
+        'library_size': size,
+        'queries': len(latencies),
+        'setup_s': setup_s,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+        'throughput_per_s': len(latencies) / total,
+        'peak_rss_mb': rss * scale / 2 ** 20,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), choices=METHODS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--fit-queries', type=int, default=5, help='queries of rf_clf/gbt_clf, which fit on every call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='JSON file, stdout if not given')
+    parser.add_argument('--case', nargs=2, metavar=('METHOD', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        method, size = args.case[0], int(args.case[1])
+        queries = args.fit_queries if method in ('rf_clf', 'gbt_clf') else args.queries
+        print(json.dumps(run_case(method, size, queries, args.seed)))
+        return
+
+    results = []
+    for size in args.sizes:
+        for method in args.methods:
+            cmd = [sys.executable, os.path.abspath(__file__), '--case', method, str(size), '--queries', str(args.queries),
+                   '--fit-queries', str(args.fit_queries), '--seed', str(args.seed)]
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+            if proc.returncode:
+                error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit {proc.returncode}'
+                result = {'method': method, 'library_size': size, 'error': error}
+            else:
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(result, file=sys.stderr)
+            results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': {'queries': args.queries, 'fit_queries': args.fit_queries, 'seed': args.seed},
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Recall and latency of the peak bin prefilter against exhaustive peak matching
+on synthetic libraries, see benchmarks/classification.py, written as JSON.
+
+    python benchmarks/prefilter.py --sizes 1000 10000 --limits 50 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from classification import synthetic_library, git_commit  # noqa: E402
+
+
+def mean_ms(fn, items):
+    t_start = time.perf_counter()
+    for item in items: fn(item)
+    return (time.perf_counter() - t_start) / len(items) * 1000
+
+
+def run(size, queries, limits, bin_width, top, seed=0):
+    from api.classification import feat_peak
+    from api.classification.matcher import PeakMatcher
+    from api.classification.prefilter import PeakBinIndex, measure_recall
+
+    library, unknowns = synthetic_library(size, queries, seed)
+    matcher = PeakMatcher({f'{i}-{name}': feat_peak.search_peaks(x, y) for i, (name, x, y) in enumerate(library)})
+    t_start = time.perf_counter()
+    index = PeakBinIndex.from_matcher(matcher, bin_width)
+    build_s = time.perf_counter() - t_start
+    peaks_list = [feat_peak.search_peaks(x, y) for _, x, y in unknowns]
+
+    result = {'library_size': size, 'queries': len(peaks_list), 'bin_width': bin_width, 'top': top,
+              'index_build_s': build_s, 'exhaustive_ms': mean_ms(matcher.compare, peaks_list), 'limits': []}
+    for limit in limits:
+        result['limits'].append({
+            'limit': limit,
+            'recall': measure_recall(matcher, index, peaks_list, limit, top),
+            'candidates_ms': mean_ms(lambda peaks: index.candidates(peaks, limit), peaks_list),
+            'prefiltered_ms': mean_ms(
+                lambda peaks: matcher.compare_candidates(peaks, index.candidates(peaks, limit)), peaks_list),
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000])
+    parser.add_argument('--limits', nargs='+', type=int, default=[50, 100, 200])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--bin-width', type=float, default=2.5)
+    parser.add_argument('--top', type=int, default=10, help='exhaustive top references a candidate list should hold')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='JSON file, stdout if not given')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        result = run(size, args.queries, args.limits, args.bin_width, args.top, args.seed)
+        print(result, file=sys.stderr)
+        results.append(result)
+    report = {'commit': git_commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
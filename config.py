@@ -19,3 +19,44 @@ class Config:
     SQLALCHEMY_DATABASE_URI = environ.get("SQLALCHEMY_DATABASE_URI")
     SQLALCHEMY_ECHO = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Spectrum storage, "binary" blobs of SPECTRUM_DTYPE or legacy "text"
+    SPECTRUM_STORAGE = environ.get("SPECTRUM_STORAGE", "binary")
+    SPECTRUM_DTYPE = environ.get("SPECTRUM_DTYPE", "float64")
+    # Also reject near-duplicate spectrums on create, see api.codec.fingerprint
+    SPECTRUM_NEAR_DUPLICATES = environ.get("SPECTRUM_NEAR_DUPLICATES", "") == "1"
+
+    # Worker-level library cache, see api.library
+    LIBRARY_CACHE_BYTES = int(environ.get("LIBRARY_CACHE_BYTES", 512 * 2 ** 20))
+    LIBRARY_VERSION_TTL = float(environ.get("LIBRARY_VERSION_TTL", 5))
+    # Shared wavenumber grid "start,stop,num" the library is resampled on
+    SPECTRUM_GRID = environ.get("SPECTRUM_GRID", "50,3500,3451")
+
+    # Peak matching only on the PEAK_CANDIDATES references sharing the most
+    # PEAK_BIN_WIDTH wide peak bins with the unknown, 0 compares the whole library
+    PEAK_CANDIDATES = int(environ.get("PEAK_CANDIDATES", 0))
+    PEAK_BIN_WIDTH = float(environ.get("PEAK_BIN_WIDTH", 2.5))
+
+    # Fitted rf/boosting models, see api.registry
+    MODEL_DIR = environ.get("MODEL_DIR", path.join(basedir, "models"))
+
+    # Siamese classification, see api.siamese_service
+    SIAMESE_MODEL = environ.get(
+        "SIAMESE_MODEL", path.join(basedir, "api", "classification", "siamese", "siamese.h5"))
+    SIAMESE_TOP_K = int(environ.get("SIAMESE_TOP_K", 10))
+    # micro-batches of concurrent requests, SIAMESE_BATCH_WAIT in seconds
+    SIAMESE_BATCH_SIZE = int(environ.get("SIAMESE_BATCH_SIZE", 64))
+    SIAMESE_BATCH_WAIT = float(environ.get("SIAMESE_BATCH_WAIT", 0.005))
+
+    # Similarity search, see api.similarity_index: the grid is summed into
+    # SIMILARITY_POINTS bins, fewer points search faster
+    SIMILARITY_TOP_K = int(environ.get("SIMILARITY_TOP_K", 10))
+    SIMILARITY_POINTS = int(environ.get("SIMILARITY_POINTS", 512))
+
+    # Mixture decomposition: NNLS over this many screened candidates per round,
+    # components under MIXTURE_MIN_FRACTION of the fit are dropped
+    MIXTURE_CANDIDATES = int(environ.get("MIXTURE_CANDIDATES", 50))
+    MIXTURE_MIN_FRACTION = float(environ.get("MIXTURE_MIN_FRACTION", 0.02))
+
+    # Also send the timing spans of api.metrics to ddtrace
+    METRICS_DDTRACE = environ.get("METRICS_DDTRACE", "") == "1"
@@ -7,10 +7,19 @@
 @Motto:With the wind light cloud light mentality, do insatiable things
 @email:ljjjun123@gmail.com 
 """
+import json
 import os
 import pickle
 import re
 
+import numpy as np
+
+# 编译好的数据库快照：全部光谱的x/y首尾相接存放在一个文件中，可直接内存映射
+# Compiled library snapshot: the x/y of all spectra back to back in one memory-mappable file
+SNAPSHOT_FILE = 'database_snapshot.bin'
+SNAPSHOT_MAGIC = b'SHINSNAP'
+SNAPSHOT_VERSION = 1
+
 
 # 拉曼数据库:raman_database
 def read_file(data_path, file_name):
@@ -68,6 +77,17 @@ def data_extraction(data_list):
     return list_spectrum
 
 
+def spectrum_array(data_list):
+    """
+    data_extraction的numpy版本，一次解析全部数据行，不为每个点建立列表。
+    Numpy version of data_extraction, parses all data rows at once without a list per point.
+    :param data_list:
+    :return: (2, n)数组，第0行为x，第1行为y。A (2, n) array, x in row 0 and y in row 1.
+    """
+    values = np.fromstring(''.join(data_list[11:-1]), dtype=np.float64, sep=' ')
+    return values.reshape(-1, 2).T
+
+
 def data_extraction_abstract(data_list):
     """
     将shining格式光谱文件（.txt或.p）对应的列表中提取出数据摘要
@@ -160,58 +180,130 @@ def existence_or_not(file_list, database_name):
     database_dictionary = pickle.load(
         open(database_path + '/' + 'database_index_file.p', 'rb'))
 
-    documents_owned_list = list(database_dictionary.keys())
-    non_existent_list = []
-    for file_name in file_list:
-        if file_name in documents_owned_list:
-            continue
-        else:
-            non_existent_list.append(file_name)
+    non_existent_list = [file_name for file_name in file_list if file_name not in database_dictionary]
 
     return non_existent_list
 
 
+def build_snapshot(database_name):
+    """
+    由索引文件和各物质的.p文件编译数据库快照，import_data后自动调用。
+    Compile the library snapshot from the index file and the .p file of every substance,
+    called by import_data.
+
+    文件结构 File layout:
+        SNAPSHOT_MAGIC, uint32版本, uint32物质数n, uint64表头长度, utf-8 json表头(物质名与摘要),
+        补齐到8字节, int64偏移表(n + 1), float64数组(2, 总点数)
+        SNAPSHOT_MAGIC, uint32 version, uint32 substance count n, uint64 header length,
+        utf-8 json header (names and abstracts), padding to 8 bytes, int64 offsets (n + 1),
+        float64 array (2, total points)
+
+    :param database_name:数据库名称。Database name
+    :return:快照文件路径。Path of the snapshot file.
+    """
+    path = os.getcwd()
+    database_path = path + '/database_folder/' + database_name
+
+    database_dictionary = pickle.load(
+        open(database_path + '/' + 'database_index_file.p', 'rb'))
+
+    names = list(database_dictionary.keys())
+    arrays = [spectrum_array(read_file_p(name, database_name)) for name in names]
+    offsets = np.zeros(len(names) + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([array.shape[1] for array in arrays])
+    abstracts = [data_extraction_abstract([''] + list(database_dictionary[name])) for name in names]
+    header = json.dumps({'names': names, 'abstracts': abstracts}, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(len(SNAPSHOT_MAGIC) + 16 + len(header)) % 8)
+
+    snapshot_path = database_path + '/' + SNAPSHOT_FILE
+    with open(snapshot_path + '.tmp', 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(np.array([SNAPSHOT_VERSION, len(names)], dtype='<u4').tobytes())
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        f.write(offsets.tobytes())
+        for row in range(2):
+            for array in arrays:
+                f.write(np.ascontiguousarray(array[row], dtype='<f8').tobytes())
+    # 一次替换，读取方只会看到完整的旧快照或新快照
+    os.replace(snapshot_path + '.tmp', snapshot_path)
+    return snapshot_path
+
+
+def load_snapshot(database_name):
+    """
+    内存映射数据库快照，快照不存在或比索引文件旧时先重新编译。
+    Memory-map the library snapshot, compiled again first when missing or older than the index file.
+
+    :param database_name:数据库名称。Database name
+    :return:(names, abstracts, offsets, xy)，第k个物质的光谱为xy[:, offsets[k]:offsets[k + 1]]。
+            The spectrum of the k-th substance is xy[:, offsets[k]:offsets[k + 1]].
+    """
+    path = os.getcwd()
+    database_path = path + '/database_folder/' + database_name
+    snapshot_path = database_path + '/' + SNAPSHOT_FILE
+    index_path = database_path + '/' + 'database_index_file.p'
+
+    if not os.path.exists(snapshot_path) or os.path.getmtime(snapshot_path) < os.path.getmtime(index_path):
+        build_snapshot(database_name)
+
+    # 普通ndarray视图切片更快，底层仍为内存映射
+    buffer = np.asarray(np.memmap(snapshot_path, dtype=np.uint8, mode='r'))
+    start = len(SNAPSHOT_MAGIC)
+    version, count = buffer[start:start + 8].view('<u4')
+    if bytes(buffer[:start]) != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        build_snapshot(database_name)
+        return load_snapshot(database_name)
+    header_length = int(buffer[start + 8:start + 16].view('<u8')[0])
+    start += 16
+    header = json.loads(bytes(buffer[start:start + header_length]).decode('utf-8'))
+    start += header_length
+    offsets = buffer[start:start + 8 * (int(count) + 1)].view('<i8')
+    start += offsets.nbytes
+    xy = buffer[start:].view('<f8').reshape(2, -1)
+    return header['names'], header['abstracts'], offsets, xy
+
+
 def read_custom(file_list, database_name):
     """
     按给定的物质列表读取光谱数据
     Read the spectral data according to the given substance list
     :param file_list:由CAS号构成的列表.List of CAS numbers.eg:['64-17-5', '67-66-3', '108-90-7', '108-88-3', '108-95-2']
     :param database_name:数据库名称。Database name
-    :return:
+    :return:以物质CAS号为键，以[x, y]为值的字典，x/y为数据库快照上的只读numpy数组。
+            A dictionary with CAS number as key and [x, y] as value, x/y are read-only numpy arrays on the snapshot.
     """
-    # 按给定的物质列表读取
+    # 按给定的物质列表读取，数据来自数据库快照
     non_existent_list = existence_or_not(file_list, database_name)
 
     if non_existent_list != []:
         raise TypeError('以下物质不存在,请剔除后重试(The following substances do not exist, please remove and try again):{}'.format(
             non_existent_list))
 
+    names, _, offsets, xy = load_snapshot(database_name)
+    position = {name: k for k, name in enumerate(names)}
+
     all_spectrum = {}
     for file_name in file_list:
-        list_spectrum = read_data(file_name, database_name)
-        all_spectrum.update({file_name: list_spectrum})
+        k = position[file_name]
+        all_spectrum.update({file_name: [xy[0, offsets[k]:offsets[k + 1]], xy[1, offsets[k]:offsets[k + 1]]]})
 
     return all_spectrum
 
 
 def read_all(database_name):
     """
-    将指定数据库的全部光谱数据加载到内存。
-    Load all spectral data of the specified database into memory.
+    将指定数据库的全部光谱数据映射到内存。
+    Map all spectral data of the specified database into memory.
     :param database_name:数据库名称。Database name
     :return:一个以物质CSA号为键，以光谱数据为值的字典。A dictionary with CSA number as key and spectral data as value.
     """
-    # 将整个数据库的光谱数据读取出来
+    # 将整个数据库的光谱数据读取出来，直接取自内存映射的数据库快照
+    names, _, offsets, xy = load_snapshot(database_name)
 
-    path = os.getcwd()
-    database_path = path + '/database_folder/' + database_name
-
-    database_dictionary = pickle.load(
-        open(database_path + '/' + 'database_index_file.p', 'rb'))
-
-    documents_owned_list = list(database_dictionary.keys())
-
-    all_spectrum = read_custom(documents_owned_list, database_name)
+    all_spectrum = {}
+    for k, name in enumerate(names):
+        all_spectrum.update({name: [xy[0, offsets[k]:offsets[k + 1]], xy[1, offsets[k]:offsets[k + 1]]]})
 
     return all_spectrum
 
@@ -334,4 +426,6 @@ def import_data(data_path, database_name='raman_database'):
     pickle.dump(database_dictionary, open(
         database_path + '/' + 'database_index_file.p', 'wb'))
 
+    build_snapshot(database_name)
+
     return database_dictionary
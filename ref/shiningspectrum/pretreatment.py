@@ -14,6 +14,8 @@ from rampy import smooth as st
 from peakutils.baseline import baseline as blp
 import pywt
 from scipy import interpolate
+from scipy import linalg
+from scipy import sparse
 
 """
 pretreatment用于对光谱数据进行预处理。
@@ -26,6 +28,11 @@ smooth(x,y,Lambda,threshold):smooth函数用于对输入数据进行平滑处理
 baseline(x, y, roi, polynomial_order):baseline函数用于光谱背景光的去除。The baseline function is used to remove the spectral background light.
 
 autbaseline(x, y, deg=3, max_it, tol):
+
+smooth_matrix(x, Y, Lambda, threshold), autbaseline_matrix(x, Y, deg, max_it, tol):
+                            smooth与autbaseline的批量版本，Y的每一行是同一x轴上的一条光谱，所有行一次处理。
+                            Batch versions of smooth and autbaseline, every row of Y is one spectrum
+                            on the shared x axis and all rows are processed at once.
 """
 
 
@@ -125,3 +132,111 @@ def uniform_layout(all_spectrum):
         uniform_spectrum.update({key: data_list})
 
     return uniform_spectrum
+
+
+def whittaker_matrix(Y, Lambda=10 ** 0.5):
+    """
+    对矩阵Y的每一行做whittaker平滑，所有行共用一次带状Cholesky分解。
+    Whittaker smoothing of every row of Y with one shared banded Cholesky factorization.
+
+    :param Y: type:numpy.ndarray，shape:(N, D)
+    :param Lambda: whittaker滤波参数
+    :return: 平滑后的Y，shape:(N, D)
+    """
+    Y = np.atleast_2d(Y)
+    L = Y.shape[1]
+    D = sparse.diags([1., -2., 1.], [0, 1, 2], shape=(L - 2, L))
+    Z = (sparse.identity(L) + Lambda * D.T.dot(D)).todia()
+    # Z为对称五对角矩阵，按上三角带状格式存储
+    ab = np.zeros((3, L))
+    for k in range(3):
+        ab[2 - k, k:] = Z.diagonal(k)
+    cb = linalg.cholesky_banded(ab)
+    return linalg.cho_solve_banded((cb, False), Y.T).T
+
+
+def smooth_matrix(x, Y, Lambda=10 ** 0.5, threshold=0.07):
+    """
+    smooth的批量版本：对所有行一次做小波阈值去噪，再共用一次分解做whittaker平滑。
+    Batch version of smooth: wavelet thresholding of all rows at once, then whittaker
+    smoothing with one shared factorization.
+
+    :param x: 共用的横轴，type:numpy.ndarray，shape:(D,)
+    :param Y: 待滤波数据，每行一条光谱，shape:(N, D)
+    :param Lambda: whittaker滤波参数
+    :param threshold: 小波过滤阈值
+    :return: x:原x;datarec:滤波后数据，与逐条调用smooth的结果一致，shape:(N, :)
+    """
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    w = pywt.Wavelet('db8')
+    maxlev = pywt.dwt_max_level(Y.shape[1], w.dec_len)
+
+    # 小波分解，沿每一行
+    coeffs = pywt.wavedec(Y, 'db8', level=maxlev, axis=-1)
+
+    # 对噪声滤波，每一行使用自己的阈值
+    for i in range(1, len(coeffs)):
+        coeffs[i] = pywt.threshold(coeffs[i], threshold * coeffs[i].max(axis=-1, keepdims=True))
+
+    # 小波重构
+    datarec = pywt.waverec(coeffs, 'db8', axis=-1)
+
+    datarec = whittaker_matrix(datarec, Lambda=Lambda)
+
+    return x, datarec
+
+
+def autbaseline_matrix(x, Y, deg=3, max_it=200, tol=None):
+    """
+    autbaseline的批量版本，所有行一起做迭代多项式拟合，每次迭代是一次矩阵乘法，已收敛的行不再更新。
+    Batch version of autbaseline. All rows are fitted together, every iteration is one matrix
+    product and rows that have converged stop updating.
+
+    与peakutils相同，收敛判断使用按max|y|缩放后的多项式系数，因此结果与逐条调用一致。
+    As in peakutils the convergence test uses the coefficients of the polynomial scaled by max|y|,
+    so the result matches calling autbaseline row by row.
+
+    :param x: 共用的横轴，type:numpy.ndarray，shape:(D,)
+    :param Y: 每行一条光谱，shape:(N, D)
+    :param deg: type:int (default: 3),拟合数据基线时的多项式阶数
+    :param max_it: type:int (default: 200)拟合时执行迭代的最大次数
+    :param tol: type:float (default: 1e-3)，收敛误差
+    :return: x:原x;Y_r:去除背景后的Y,shape:(N, D);Y_base,背景数据，shape:(N, D)
+    """
+    if tol is None: tol = 1e-3
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    order = deg + 1
+
+    # peakutils在[0, max|y|^(1/order)]上拟合，等价于在[0, 1]上拟合后按行缩放系数
+    t = np.linspace(0., 1., Y.shape[1])
+    vander = np.vander(t, order)
+    vander_pinv = linalg.pinv(vander)
+    powers = np.arange(order - 1, -1, -1)
+    with np.errstate(divide='ignore'):
+        scale = np.abs(Y).max(axis=1, keepdims=True) ** (-powers / order)
+
+    # 只保留未收敛的行参与迭代，收敛时写回其基线
+    active = np.arange(Y.shape[0])
+    coeffs = np.ones((Y.shape[0], order))
+    base = Y.copy()
+    active_base = Y.copy()
+    y = Y.copy()
+    for _ in range(max_it):
+        if not len(active): break
+        fitted = y.dot(vander_pinv.T)
+        with np.errstate(invalid='ignore'):
+            coeffs_new = fitted * scale
+            converged = np.linalg.norm(coeffs_new - coeffs, axis=1) / np.linalg.norm(coeffs, axis=1) < tol
+
+        if converged.any():
+            base[active[converged]] = active_base[converged]
+            keep = ~converged
+            active, y, scale = active[keep], y[keep], scale[keep]
+            fitted, coeffs_new = fitted[keep], coeffs_new[keep]
+
+        coeffs = coeffs_new
+        active_base = fitted.dot(vander.T)
+        np.minimum(y, active_base, out=y)
+
+    base[active] = active_base
+    return x, Y - base, base
@@ -7,15 +7,16 @@
 @Motto:With the wind light cloud light mentality, do insatiable things
 @email:ljjjun123@gmail.com 
 """
+import atexit
+import hashlib
 import os
 
 from scipy import interpolate
 
 import numpy as np
 
-import math
-
-from multiprocessing import  Manager, Pool
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 import time
 from shiningspectrum import peak_processing
 from . import spectrafit
@@ -84,16 +85,99 @@ def sum_spectra(comp1_data_int, comp2_data_int):
     return x_combined, y_combined
 
 
-def combine_spectra(compound_1, compound_2):
-    data1 = clean_spectra(compound_1)
-    data2 = clean_spectra(compound_2)
+def mixture_grid(compounds, step=1):
+    """
+    所有组分共用的整数波数网格，覆盖各组分x范围的并集，与interpolate_spectra的取点方式一致。
+    Shared wavenumber grid of all components, the union of their x ranges, spaced like interpolate_spectra.
+    """
+    start = min(int(np.min(c['x'])) + 1 for c in compounds)
+    stop = max(int(np.max(c['x'])) for c in compounds)
+    return np.arange(start, stop, step, dtype=float)
 
-    comp1_data_int = interpolate_spectra(data1)
-    comp2_data_int = interpolate_spectra(data2)
 
-    x_combined, y_combined = sum_spectra(comp1_data_int, comp2_data_int)
+def component_matrix(compounds, grid, kind='cubic', baseline=True):
+    """
+    K个组分扣除基线后插值到同一网格上，组成(K, len(grid))矩阵，组分x范围外为0。
+    Baseline-subtracted components interpolated onto one grid as a (K, len(grid)) matrix,
+    0 outside the x range of each component.
 
-    return x_combined, y_combined
+    :param kind: 'cubic'（与interp1d(kind='cubic')相同）或'linear'。'cubic' (as interp1d) or 'linear'.
+    :param baseline: 是否先用spectrafit.subtract_baseline扣除基线。Subtract the spectrafit baseline first.
+    """
+    grid = np.asarray(grid, dtype=float)
+    components = np.zeros((len(compounds), len(grid)))
+    for k, compound in enumerate(compounds):
+        x = np.asarray(compound['x'], dtype=float)
+        y = np.asarray(spectrafit.subtract_baseline(compound['y']) if baseline else compound['y'], dtype=float)
+        # 按x排序并去除重复的x，保留第一个
+        x, first = np.unique(x, return_index=True)
+        y = y[first]
+        inside = (grid >= x[0]) & (grid <= x[-1])
+        if kind == 'cubic':
+            components[k, inside] = interpolate.make_interp_spline(x, y, k=3)(grid[inside])
+        else:
+            components[k, inside] = np.interp(grid[inside], x, y)
+    return components
+
+
+def mix_spectra(components, weights):
+    """
+    由组分矩阵和权重一次矩阵乘法生成混合光谱。
+    Mixtures of the components as one matrix product.
+
+    :param components: (K, G) component_matrix的结果。Output of component_matrix.
+    :param weights: (M, K) 每行为一个混合物中各组分的权重，或(K,)单个混合物。
+                    One row of component weights per mixture, or (K,) for one mixture.
+    :return: (M, G)或(G,)的混合光谱。Mixture spectra, (G,) for a single weight vector.
+    """
+    return np.asarray(weights, dtype=components.dtype) @ components
+
+
+def random_weights(mixtures, n_compounds, n_components=2, rng=None):
+    """
+    随机混合比例：每个混合物随机选n_components个组分，比例服从Dirichlet(1)分布，每行之和为1。
+    Random fractions: n_components components per mixture, Dirichlet(1) distributed, rows sum to 1.
+
+    :param n_components: 整数，或(最少, 最多)组分数。An int, or (min, max) components per mixture.
+    :return: (mixtures, n_compounds)权重矩阵。Weight matrix.
+    """
+    rng = np.random.default_rng(rng)
+    low, high = (n_components, n_components) if np.isscalar(n_components) else n_components
+    counts = rng.integers(low, min(high, n_compounds) + 1, size=mixtures)
+    # 每行随机排列后取前counts个组分
+    ranks = np.argsort(rng.random((mixtures, n_compounds)), axis=1).argsort(axis=1)
+    weights = rng.gamma(1.0, size=(mixtures, n_compounds)) * (ranks < counts[:, None])
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def synthesize_mixtures(compounds, mixtures, n_components=2, noise=0.0, step=1, kind='cubic', rng=None):
+    """
+    批量生成合成混合光谱，用于扩充训练数据或测试component_testing的混合物识别。
+    Synthetic mixture spectra in bulk, for training data augmentation or testing the
+    mixture identification of component_testing.
+
+    :param compounds: shining2noodles格式的组分列表。Components as returned by shining2noodles.
+    :param mixtures: 生成的混合物数量。Number of mixtures.
+    :param noise: 高斯噪声标准差，相对于每条光谱的最大值。Gaussian noise sigma relative to the maximum of each spectrum.
+    :return: (grid, spectra (mixtures, G), weights (mixtures, K))
+    """
+    rng = np.random.default_rng(rng)
+    grid = mixture_grid(compounds, step)
+    components = component_matrix(compounds, grid, kind)
+    weights = random_weights(mixtures, len(compounds), n_components, rng)
+    spectra = mix_spectra(components, weights)
+    if noise:
+        scale = np.abs(spectra).max(axis=1, keepdims=True)
+        spectra += rng.normal(0.0, 1.0, spectra.shape) * (noise * scale)
+    return grid, spectra, weights
+
+
+def combine_spectra(compound_1, compound_2):
+    # 两个组分等权相加，见synthesize_mixtures
+    grid = mixture_grid([compound_1, compound_2])
+    y_combined = mix_spectra(component_matrix([compound_1, compound_2], grid), np.ones(2))
+
+    return grid, y_combined
 
 
 # ————————————————————————————————————————————————————————————
@@ -107,6 +191,113 @@ def shining2noodles(all_spectrum):
 
     return list_of_compounds
 
+# ————————————————————————————————————————————————————————————
+# 常驻进程池：component_testing.peak_assignment 的所有调用共用一个进程池，
+# 光谱数据库在建池时载入各进程，数据库变化时才重建。寻峰在池中进行，峰位写入共享数组。
+_pool = None
+_pool_size = 0
+_pool_key = None
+_library_peaks = {}  # library_key -> 每个化合物的峰位列表，只保存当前进程池的数据库
+
+# 子进程中的数据库：各化合物的(x, y)，以及共享的峰位数组。第k个化合物排序后的峰位
+# 为 positions[starts[k]:starts[k] + counts[k]]，由寻峰任务写入
+_worker_compounds = None
+_worker_positions = None
+_worker_starts = None
+_worker_counts = None
+
+
+def library_key(known_compound_list, height, distance):
+    # 数据库内容和寻峰参数的摘要，内容不变则峰位不变
+    digest = hashlib.sha1(repr((height, distance, len(known_compound_list))).encode())
+    for compound in known_compound_list:
+        digest.update(str(compound["title"]).encode())
+        digest.update(np.asarray(compound["x"], dtype=float).tobytes())
+        digest.update(np.asarray(compound["y"], dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def _init_worker(compounds, positions, starts, counts):
+    global _worker_compounds, _worker_positions, _worker_starts, _worker_counts
+    _worker_compounds, _worker_starts = compounds, starts
+    _worker_positions = np.frombuffer(positions, dtype=np.float64)
+    _worker_counts = np.frombuffer(counts, dtype=np.int64)
+
+
+def _get_pool(processes, key, known_compound_list, distance):
+    """
+    返回常驻进程池，池中进程已载入 key 对应的数据库。数据库或进程数变化时重建进程池，
+    此时共享峰位数组为空，缓存的峰位一并清除。
+    """
+    global _pool, _pool_size, _pool_key
+    if _pool is not None and _pool_size == processes and key == _pool_key:
+        return _pool
+    if _pool is not None:
+        _pool.terminate()
+    _library_peaks.clear()
+    compounds = [(np.asarray(c["x"], dtype=float), np.asarray(c["y"], dtype=float)) for c in known_compound_list]
+    # 每个化合物预留的峰位数上限：find_peaks 找到的峰至少相隔 distance 个点
+    step = max(int(distance or 1), 1)
+    starts = np.zeros(len(compounds) + 1, dtype=np.int64)
+    np.cumsum([len(y) // step + 1 for _, y in compounds], out=starts[1:])
+    positions = RawArray('d', max(int(starts[-1]), 1))
+    counts = RawArray('q', max(len(compounds), 1))
+    print("建立进程池，进程数{}".format(processes))
+    _pool = Pool(processes, initializer=_init_worker, initargs=(compounds, positions, starts, counts))
+    _pool_size, _pool_key = processes, key
+    return _pool
+
+
+def _close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+atexit.register(_close_pool)
+
+
+def _chunks(n, processes):
+    # 每个进程约四个任务，兼顾负载均衡和通信开销
+    size = max(1, -(-n // (processes * 4)))
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def _close_peaks(unknown, known, precision):
+    # The peaks within rel_tol of an unknown peak form one interval, so it is
+    # enough to test the nearest known peak on each side of it. known is sorted.
+    close = np.zeros(len(unknown), dtype=bool)
+    if not len(known):
+        return close
+    idx = np.searchsorted(known, unknown)
+    for side in (np.clip(idx - 1, 0, None), np.clip(idx, None, len(known) - 1)):
+        neighbour = known[side]
+        close |= np.abs(unknown - neighbour) <= precision * np.maximum(np.abs(unknown), np.abs(neighbour))
+    return close
+
+
+def _search_chunk(start, end, height, distance):
+    # 寻峰并把排序后的峰位写入共享数组，供之后的比对任务使用
+    chunk = []
+    for k in range(start, end):
+        x, y = _worker_compounds[k]
+        centers = [peak[0] for peak in peak_processing.search_peaks(x, y, height=height, distance=distance)]
+        _worker_positions[_worker_starts[k]:_worker_starts[k] + len(centers)] = np.sort(centers)
+        _worker_counts[k] = len(centers)
+        chunk.append(centers)
+    return chunk
+
+
+def _assign_chunk(start, end, unknown_peaks, precision):
+    unknown = np.asarray(unknown_peaks, dtype=float)
+    matrix = np.zeros((end - start, len(unknown)))
+    for k in range(start, end):
+        known = _worker_positions[_worker_starts[k]:_worker_starts[k] + _worker_counts[k]]
+        matrix[k - start][_close_peaks(unknown, known, precision)] = 1
+    return list(matrix)
+
+
 class component_testing:
 
     def __init__(self, height=0.1, prominence_unknow='auto', prominence_know='auto', distance=10, precision=0.03):
@@ -125,35 +316,24 @@ class component_testing:
         self.distance = distance
         self.precision = precision
 
-    def run_mp(self, unknown_peaks, known_compound):
-        t_start = time.time()
-        print("进程{}启动".format(os.getpid()))
-
-        peaks = peak_processing.search_peaks(known_compound["x"], known_compound["y"], height=self.height,
-                                                distance=self.distance)
-        known_compound_peaks = []
-        for i in peaks:
-            known_compound_peaks.append(i[0])
-
-
-        #known_compound_peaks = self.compound_report(known_compound, schema='know')[0]
-
-        assignment_matrix = self.compare_unknown_to_known(unknown_peaks, known_compound_peaks, self.precision)
-
-        result_dic = {"known_compound_peaks": known_compound_peaks, "assignment_matrix": assignment_matrix}
-        #known_compound_peaks.append(self.compound_report(known_compound))
-
-        #assignment_matrix.append(self.compare_unknown_to_known(unknown_peaks, known_compound, self.precision))
-
-        t_stop = time.time()
-        print("进程{}结束，耗时{}".format(os.getpid(), t_stop - t_start))
-
-        return result_dic
+    def library_peaks(self, known_compound_list, processes):
+        """
+        光谱数据库中每个化合物的峰位，按数据库内容缓存，数据库不变时只寻峰一次。
+        Peak centers of every known compound, searched once per library content
+        by the pool that then compares against them.
 
+        :return: (进程池, 峰位列表)
+        """
+        key = library_key(known_compound_list, self.height, self.distance)
+        pool = _get_pool(processes, key, known_compound_list, self.distance)
+        if key not in _library_peaks:
+            jobs = [pool.apply_async(_search_chunk, (start, end, self.height, self.distance))
+                    for start, end in _chunks(len(known_compound_list), processes)]
+            _library_peaks[key] = [peaks for job in jobs for peaks in job.get()]
+        return pool, _library_peaks[key]
 
     def peak_assignment(self, unknow_compound, known_compound_list, processes_max=7):
 
-
         t_start = time.time()
         print("开始寻找未知物峰值。")
         
@@ -166,39 +346,16 @@ class component_testing:
         t_stop = time.time()
         print("未知物寻峰结束，耗时{}".format(t_stop - t_start))
 
-        if len(known_compound_list) > processes_max:
-            processes = len(known_compound_list)
-        else:
-            processes = processes_max
-        manager = Manager()
-
-
-        #known_compound_peaks = manager.list()
-
-        #assignment_matrix = manager.list()
-        datalist = []
-        po = Pool(processes)
-        print("建立进程池")
+        # 进程池只建立一次，进程数不超过CPU核数；数据库预先载入各进程，寻峰和比对都按段分给各进程。
+        processes = max(1, min(processes_max, os.cpu_count() or 1))
+        pool, known_compound_peaks = self.library_peaks(known_compound_list, processes)
 
-        for known_compound in known_compound_list:
+        jobs = [pool.apply_async(_assign_chunk, (start, end, unkonw_peak_center, self.precision))
+                for start, end in _chunks(len(known_compound_list), processes)]
+        assignment_matrix = [row for job in jobs for row in job.get()]
 
-            datalist.append(po.apply_async(self.run_mp, (unkonw_peak_center, known_compound)))
+        print("进程池计算完毕，耗时{}".format(time.time() - t_stop))
 
-        po.close()
-        po.join()
-
-        print("进程池计算完毕，开始比对")
-        print("datalist:{},known_compound_list:{}".format(len(datalist), len(known_compound_list)))
-
-        known_compound_peaks = []
-
-        assignment_matrix = []
-        for data_ele_pool in datalist:
-            data_ele = data_ele_pool.get()
-            known_compound_peaks.append(data_ele["known_compound_peaks"])
-            assignment_matrix.append(data_ele["assignment_matrix"])
-
-        # import ipdb; ipdb.set_trace()
         unknown_peak_assignments = self.peak_position_comparisons(unkonw_peak_center,
                                                              known_compound_peaks,
                                                              known_compound_list,
@@ -310,23 +467,9 @@ class component_testing:
             Instead, it is: """ + str(type(precision)))
 
         assignment_matrix = np.zeros(len(combined_peaks))
-        peaks_found = 0
-        for i, _ in enumerate(combined_peaks):
-            for j, _ in enumerate(known_peaks):
-                # instead of If, call peak_1D_score
-                if math.isclose(combined_peaks[i], known_peaks[j],
-                                rel_tol=precision):
-                    # Instead of using a 1, just input the score
-                    # from the score calculator.
-                    # Bigger is better.
-                    # Storing only the second component in the list.
-                    assignment_matrix[i] = 1
-                    peaks_found += 1
-                    continue
-                else:
-                    pass
-            if peaks_found == len(known_peaks):
-                continue
-            else:
-                pass
-        return assignment_matrix
\ No newline at end of file
+        if not known_peaks:
+            return assignment_matrix
+
+        known = np.sort(np.asarray(known_peaks, dtype=float))
+        assignment_matrix[_close_peaks(np.asarray(combined_peaks, dtype=float), known, precision)] = 1
+        return assignment_matrix